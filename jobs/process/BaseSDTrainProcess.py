@@ -1,10 +1,11 @@
 import copy
-import glob
 import inspect
+import itertools
 import json
 import random
 import shutil
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, Future
 import os
 import re
 from typing import Union, List, Optional
@@ -13,7 +14,7 @@ import numpy as np
 import yaml
 from diffusers import T2IAdapter, ControlNetModel
 from diffusers.training_utils import compute_density_for_timestep_sampling
-from safetensors.torch import save_file, load_file
+from safetensors.torch import save_file
 # from lycoris.config import PRESET
 from torch.utils.data import DataLoader
 import torch
@@ -41,7 +42,7 @@ from toolkit.progress_bar import ToolkitProgressBar
 from toolkit.reference_adapter import ReferenceAdapter
 from toolkit.sampler import get_sampler
 from toolkit.saving import save_t2i_from_diffusers, load_t2i_model, save_ip_adapter_from_diffusers, \
-    load_ip_adapter_model, load_custom_adapter_model
+    load_ip_adapter_model, load_custom_adapter_model, save_file_bulk, load_file_to_device
 
 from toolkit.scheduler import get_lr_scheduler
 from toolkit.sd_device_states_presets import get_train_sd_device_state_preset
@@ -65,9 +66,36 @@ def flush():
     gc.collect()
 
 
+def freeze_module_to_device(module: torch.nn.Module, device: torch.device, dtype: torch.dtype):
+    # moves the module and turns off grads in a single pass over the tensors, then sets it to eval.
+    # cpu tensors going to cuda are pinned and copied non blocking so the pinning of the next
+    # tensor overlaps the copy of the current one. Anything we cannot move here is handled by module.to
+    needs_module_to = False
+    for tensor in itertools.chain(module.parameters(), module.buffers()):
+        if isinstance(tensor, torch.nn.Parameter):
+            tensor.requires_grad_(False)
+        if type(tensor.data) is not torch.Tensor:
+            # quantized, etc
+            needs_module_to = True
+            continue
+        tensor_dtype = dtype if tensor.is_floating_point() else tensor.dtype
+        if device.type == 'cuda' and tensor.device.type == 'cpu':
+            tensor.data = tensor.data.pin_memory().to(device, dtype=tensor_dtype, non_blocking=True)
+        else:
+            tensor.data = tensor.data.to(device, dtype=tensor_dtype)
+    if needs_module_to:
+        module.to(device, dtype=dtype)
+    module.eval()
+    return module
+
+
 class BaseSDTrainProcess(BaseTrainProcess):
 
     def __init__(self, process_id: int, job, config: OrderedDict, custom_pipeline=None):
+        # mixed resolutions fragment the cuda allocator. Let it grow segments instead. This is read
+        # when the allocator is first used, so it has to be set before anything touches cuda
+        if 'PYTORCH_CUDA_ALLOC_CONF' not in os.environ and not torch.cuda.is_initialized():
+            os.environ['PYTORCH_CUDA_ALLOC_CONF'] = 'expandable_segments:True'
         super().__init__(process_id, job, config)
         self.sd: StableDiffusion
         self.embedding: Union[Embedding, None] = None
@@ -80,6 +108,9 @@ class BaseSDTrainProcess(BaseTrainProcess):
         self.grad_accumulation_step = 1
         # if true, then we do not do an optimizer step. We are accumulating gradients
         self.is_grad_accumulation_step = False
+        # automatic gc is disabled during the train loop and a gen 1 collection is run every gc_freq steps
+        # set to 0 to leave python gc automatic
+        self.gc_freq = self.get_conf('gc_freq', 1000)
         self.device = self.get_conf('device', self.job.device)
         self.device_torch = torch.device(self.device)
         network_config = self.get_conf('network', None)
@@ -95,6 +126,9 @@ class BaseSDTrainProcess(BaseTrainProcess):
         self.model_config = ModelConfig(**model_config)
 
         self.save_config = SaveConfig(**self.get_conf('save', {}))
+        # parsed once instead of on every batch and save
+        self._save_dtype = get_torch_dtype(self.save_config.dtype)
+        self._train_dtype = get_torch_dtype(self.train_config.dtype)
         self.sample_config = SampleConfig(**self.get_conf('sample', {}))
         first_sample_config = self.get_conf('first_sample', None)
         if first_sample_config is not None:
@@ -111,6 +145,32 @@ class BaseSDTrainProcess(BaseTrainProcess):
         self.data_loader_reg: Union[DataLoader, None] = None
         self.trigger_word = self.get_conf('trigger_word', None)
 
+        # metadata that does not change during training. Built once and added on every save
+        self._static_meta = OrderedDict()
+        if self.model_config.is_v2:
+            self._static_meta['ss_v2'] = True
+            self._static_meta['ss_base_model_version'] = 'sd_2.1'
+
+        elif self.model_config.is_xl:
+            self._static_meta['ss_base_model_version'] = 'sdxl_1.0'
+        else:
+            self._static_meta['ss_base_model_version'] = 'sd_1.5'
+
+        self._static_meta = add_base_model_info_to_meta(
+            self._static_meta,
+            is_v2=self.model_config.is_v2,
+            is_xl=self.model_config.is_xl,
+        )
+        self._static_meta['ss_output_name'] = self.job.name
+
+        if self.trigger_word is not None:
+            # just so auto1111 will pick it up
+            self._static_meta['ss_tag_frequency'] = {
+                f"1_{self.trigger_word}": {
+                    f"{self.trigger_word}": 1
+                }
+            }
+
         self.guidance_config: Union[GuidanceConfig, None] = None
         guidance_config_raw = self.get_conf('guidance', None)
         if guidance_config_raw is not None:
@@ -202,7 +262,13 @@ class BaseSDTrainProcess(BaseTrainProcess):
             self.named_lora = True
         self.snr_gos: Union[LearnableSNRGamma, None] = None
         self.ema: ExponentialMovingAverage = None
-        
+
+        # network weights are staged to cpu on the main thread and written to disk in the background
+        self._save_executor = ThreadPoolExecutor(max_workers=1)
+        self._save_futures: List[Future] = []
+        # path of a save whose write is still running, finished by wait_for_save
+        self._pending_save_path: Optional[str] = None
+
         validate_configs(self.train_config, self.model_config, self.save_config)
 
     def post_process_generate_image_config_list(self, generate_image_config_list: List[GenerateImageConfig]):
@@ -227,19 +293,36 @@ class BaseSDTrainProcess(BaseTrainProcess):
             for i in range(len(sample_config.prompts)):
                 test_image_paths.append(test_image_path_list[i % len(test_image_path_list)])
 
+        step_num = ''
+        if step is not None:
+            # zero-pad 9 digits
+            step_num = f"_{step:09d}"
+
+        filename = f"[time]_{step_num}_[count].{self.sample_config.ext}"
+
+        output_path = os.path.join(sample_folder, filename)
+
+        # these are the same for every prompt
+        shared_gen_kwargs = dict(
+            width=sample_config.width,
+            height=sample_config.height,
+            negative_prompt=sample_config.neg,
+            guidance_scale=sample_config.guidance_scale,
+            guidance_rescale=sample_config.guidance_rescale,
+            num_inference_steps=sample_config.sample_steps,
+            network_multiplier=sample_config.network_multiplier,
+            output_path=output_path,
+            output_ext=sample_config.ext,
+            adapter_conditioning_scale=sample_config.adapter_conditioning_scale,
+            refiner_start_at=sample_config.refiner_start_at,
+            extra_values=sample_config.extra_values,
+            logger=self.logger,
+        )
+
         for i in range(len(sample_config.prompts)):
             if sample_config.walk_seed:
                 current_seed = start_seed + i
 
-            step_num = ''
-            if step is not None:
-                # zero-pad 9 digits
-                step_num = f"_{str(step).zfill(9)}"
-
-            filename = f"[time]_{step_num}_[count].{self.sample_config.ext}"
-
-            output_path = os.path.join(sample_folder, filename)
-
             prompt = sample_config.prompts[i]
 
             # add embedding if there is one
@@ -264,20 +347,8 @@ class BaseSDTrainProcess(BaseTrainProcess):
 
             gen_img_config_list.append(GenerateImageConfig(
                 prompt=prompt,  # it will autoparse the prompt
-                width=sample_config.width,
-                height=sample_config.height,
-                negative_prompt=sample_config.neg,
                 seed=current_seed,
-                guidance_scale=sample_config.guidance_scale,
-                guidance_rescale=sample_config.guidance_rescale,
-                num_inference_steps=sample_config.sample_steps,
-                network_multiplier=sample_config.network_multiplier,
-                output_path=output_path,
-                output_ext=sample_config.ext,
-                adapter_conditioning_scale=sample_config.adapter_conditioning_scale,
-                refiner_start_at=sample_config.refiner_start_at,
-                extra_values=sample_config.extra_values,
-                logger=self.logger,
+                **shared_gen_kwargs,
                 **extra_args
             ))
 
@@ -298,30 +369,7 @@ class BaseSDTrainProcess(BaseTrainProcess):
         o_dict = OrderedDict({
             "training_info": self.get_training_info()
         })
-        if self.model_config.is_v2:
-            o_dict['ss_v2'] = True
-            o_dict['ss_base_model_version'] = 'sd_2.1'
-
-        elif self.model_config.is_xl:
-            o_dict['ss_base_model_version'] = 'sdxl_1.0'
-        else:
-            o_dict['ss_base_model_version'] = 'sd_1.5'
-
-        o_dict = add_base_model_info_to_meta(
-            o_dict,
-            is_v2=self.model_config.is_v2,
-            is_xl=self.model_config.is_xl,
-        )
-        o_dict['ss_output_name'] = self.job.name
-
-        if self.trigger_word is not None:
-            # just so auto1111 will pick it up
-            o_dict['ss_tag_frequency'] = {
-                f"1_{self.trigger_word}": {
-                    f"{self.trigger_word}": 1
-                }
-            }
-
+        o_dict.update(self._static_meta)
         self.add_meta(o_dict)
 
     def get_training_info(self):
@@ -331,45 +379,54 @@ class BaseSDTrainProcess(BaseTrainProcess):
         })
         return info
 
+    def get_save_root_entries(self) -> List[os.DirEntry]:
+        # single directory listing. DirEntry caches its stat so sorting by ctime does not stat again
+        if not os.path.exists(self.save_root):
+            return []
+        with os.scandir(self.save_root) as it:
+            return list(it)
+
     def clean_up_saves(self):
         # remove old saves
         # get latest saved step
         latest_item = None
         if os.path.exists(self.save_root):
+            entries = self.get_save_root_entries()
+
+            def get_ctime(entry: os.DirEntry):
+                return entry.stat().st_ctime
+
             # pattern is {job_name}_{zero_filled_step} for both files and directories
-            pattern = f"{self.job.name}_*"
-            items = glob.glob(os.path.join(self.save_root, pattern))
+            prefix = f"{self.job.name}_"
+            items = [e for e in entries if e.name.startswith(prefix)]
             # Separate files and directories
-            safetensors_files = [f for f in items if f.endswith('.safetensors')]
-            pt_files = [f for f in items if f.endswith('.pt')]
-            directories = [d for d in items if os.path.isdir(d) and not d.endswith('.safetensors')]
+            safetensors_files = [e for e in items if e.name.endswith('.safetensors')]
+            pt_files = [e for e in items if e.name.endswith('.pt')]
+            directories = [e for e in items if e.is_dir() and not e.name.endswith('.safetensors')]
             embed_files = []
             # do embedding files
             if self.embed_config is not None:
-                embed_pattern = f"{self.embed_config.trigger}_*"
-                embed_items = glob.glob(os.path.join(self.save_root, embed_pattern))
+                embed_prefix = f"{self.embed_config.trigger}_"
                 # will end in safetensors or pt
-                embed_files = [f for f in embed_items if f.endswith('.safetensors') or f.endswith('.pt')]
+                embed_files = [
+                    e for e in entries
+                    if e.name.startswith(embed_prefix) and (e.name.endswith('.safetensors') or e.name.endswith('.pt'))
+                ]
 
             # check for critic files
-            critic_pattern = f"CRITIC_{self.job.name}_*"
-            critic_items = glob.glob(os.path.join(self.save_root, critic_pattern))
-
-            # Sort the lists by creation time if they are not empty
-            if safetensors_files:
-                safetensors_files.sort(key=os.path.getctime)
-            if pt_files:
-                pt_files.sort(key=os.path.getctime)
-            if directories:
-                directories.sort(key=os.path.getctime)
-            if embed_files:
-                embed_files.sort(key=os.path.getctime)
-            if critic_items:
-                critic_items.sort(key=os.path.getctime)
+            critic_prefix = f"CRITIC_{self.job.name}_"
+            critic_items = [e for e in entries if e.name.startswith(critic_prefix)]
+
+            # Sort the lists by creation time
+            safetensors_files.sort(key=get_ctime)
+            pt_files.sort(key=get_ctime)
+            directories.sort(key=get_ctime)
+            embed_files.sort(key=get_ctime)
+            critic_items.sort(key=get_ctime)
 
             # Combine and sort the lists
             combined_items = safetensors_files + directories + pt_files
-            combined_items.sort(key=os.path.getctime)
+            combined_items.sort(key=get_ctime)
 
             # Use slicing with a check to avoid 'NoneType' error
             safetensors_to_remove = safetensors_files[
@@ -385,7 +442,7 @@ class BaseSDTrainProcess(BaseTrainProcess):
             # items_to_remove = combined_items[:-self.save_config.max_step_saves_to_keep]
 
             # remove duplicates
-            items_to_remove = list(dict.fromkeys(items_to_remove))
+            items_to_remove = list(dict.fromkeys([e.path for e in items_to_remove]))
 
             for item in items_to_remove:
                 self.print(f"Removing old save: {item}")
@@ -398,14 +455,35 @@ class BaseSDTrainProcess(BaseTrainProcess):
                 if os.path.exists(yaml_file):
                     os.remove(yaml_file)
             if combined_items:
-                latest_item = combined_items[-1]
+                latest_item = combined_items[-1].path
         return latest_item
 
     def post_save_hook(self, save_path):
-        # override in subclass
+        # override in subclass. Always called on the main thread once the save is on disk
         pass
 
+    def finish_save(self, file_path):
+        self.print(f"Saved to {file_path}")
+        self.clean_up_saves()
+        self.post_save_hook(file_path)
+
+    def wait_for_save(self):
+        # block until any background writes from the previous save are done, then finish it here
+        for future in self._save_futures:
+            future.result()
+        self._save_futures = []
+        if self._pending_save_path is not None:
+            file_path = self._pending_save_path
+            self._pending_save_path = None
+            self.finish_save(file_path)
+
+    def collect_finished_save(self):
+        # non blocking, called every step so a background save is finished as soon as its write is done
+        if len(self._save_futures) > 0 and all(future.done() for future in self._save_futures):
+            self.wait_for_save()
+
     def save(self, step=None):
+        self.wait_for_save()
         flush()
         if self.ema is not None:
             # always save params as ema
@@ -417,7 +495,7 @@ class BaseSDTrainProcess(BaseTrainProcess):
         step_num = ''
         if step is not None:
             # zeropad 9 digits
-            step_num = f"_{str(step).zfill(9)}"
+            step_num = f"_{step:09d}"
 
         self.update_training_metadata()
         filename = f'{self.job.name}{step_num}.safetensors'
@@ -442,18 +520,17 @@ class BaseSDTrainProcess(BaseTrainProcess):
 
                 filename = f'{lora_name}{step_num}.safetensors'
                 file_path = os.path.join(self.save_root, filename)
-                prev_multiplier = self.network.multiplier
-                self.network.multiplier = 1.0
 
                 # if we are doing embedding training as well, add that
                 embedding_dict = self.embedding.state_dict() if self.embedding else None
-                self.network.save_weights(
-                    file_path,
-                    dtype=get_torch_dtype(self.save_config.dtype),
+                save_dict, network_meta = self.network.get_save_dict(
+                    dtype=self._save_dtype,
                     metadata=save_meta,
                     extra_state_dict=embedding_dict
                 )
-                self.network.multiplier = prev_multiplier
+                self._save_futures.append(
+                    self._save_executor.submit(save_file_bulk, save_dict, file_path, network_meta)
+                )
                 # if we have an embedding as well, pair it with the network
 
             # even if added to lora, still save the trigger version
@@ -493,7 +570,7 @@ class BaseSDTrainProcess(BaseTrainProcess):
                         state_dict,
                         output_file=file_path,
                         meta=save_meta,
-                        dtype=get_torch_dtype(self.save_config.dtype)
+                        dtype=self._save_dtype
                     )
                 elif self.adapter_config.type == 'control_net':
                     # save in diffusers format
@@ -501,10 +578,10 @@ class BaseSDTrainProcess(BaseTrainProcess):
                     # move it to the new dtype and cpu
                     orig_device = self.adapter.device
                     orig_dtype = self.adapter.dtype
-                    self.adapter = self.adapter.to(torch.device('cpu'), dtype=get_torch_dtype(self.save_config.dtype))
+                    self.adapter = self.adapter.to(torch.device('cpu'), dtype=self._save_dtype)
                     self.adapter.save_pretrained(
                         name_or_path,
-                        dtype=get_torch_dtype(self.save_config.dtype),
+                        dtype=self._save_dtype,
                         safe_serialization=True
                     )
                     meta_path = os.path.join(name_or_path, 'aitk_meta.yaml')
@@ -522,7 +599,7 @@ class BaseSDTrainProcess(BaseTrainProcess):
                         state_dict,
                         output_file=file_path,
                         meta=save_meta,
-                        dtype=get_torch_dtype(self.save_config.dtype),
+                        dtype=self._save_dtype,
                         direct_save=direct_save
                     )
         else:
@@ -540,13 +617,13 @@ class BaseSDTrainProcess(BaseTrainProcess):
                 self.sd.save_refiner(
                     file_path,
                     save_meta,
-                    get_torch_dtype(self.save_config.dtype)
+                    self._save_dtype
                 )
             if self.train_config.train_unet or self.train_config.train_text_encoder:
                 self.sd.save(
                     file_path,
                     save_meta,
-                    get_torch_dtype(self.save_config.dtype)
+                    self._save_dtype
                 )
 
         # save learnable params as json if we have thim
@@ -572,9 +649,11 @@ class BaseSDTrainProcess(BaseTrainProcess):
                 print(e)
                 print("Could not save optimizer")
 
-        self.print(f"Saved to {file_path}")
-        self.clean_up_saves()
-        self.post_save_hook(file_path)
+        if len(self._save_futures) > 0:
+            # finished on the main thread once the background write is done, see collect_finished_save
+            self._pending_save_path = file_path
+        else:
+            self.finish_save(file_path)
 
         if self.ema is not None:
             self.ema.train()
@@ -631,38 +710,58 @@ class BaseSDTrainProcess(BaseTrainProcess):
         # return loss
         return 0.0
 
+    def iterate_dataloader_forever(self, dataloader: DataLoader, is_reg=False):
+        # yields batches endlessly and handles the epoch reset when the dataloader runs out,
+        # so the train loop does not need a try/except around every batch
+        # timers are started directly since the caller is already inside a timer context
+        reset_timer_name = 'reset_batch:reg' if is_reg else 'reset_batch'
+        dataloader_iterator = iter(dataloader)
+        while True:
+            num_batches = 0
+            for batch in dataloader_iterator:
+                num_batches += 1
+                yield batch
+            if num_batches == 0:
+                # empty dataloader, let next() raise StopIteration
+                return
+            # hit the end of an epoch, reset
+            self.timer.start(reset_timer_name)
+            self.progress_bar.pause()
+            dataloader_iterator = iter(dataloader)
+            trigger_dataloader_setup_epoch(dataloader)
+            if not is_reg:
+                self.epoch_num += 1
+                if self.train_config.gradient_accumulation_steps == -1:
+                    # if we are accumulating for an entire epoch, trigger a step
+                    self.is_grad_accumulation_step = False
+                    self.grad_accumulation_step = 0
+            self.timer.stop(reset_timer_name)
+            self.progress_bar.unpause()
+
     def get_latest_save_path(self, name=None, post=''):
         if name == None:
             name = self.job.name
         # get latest saved step
         latest_path = None
         if os.path.exists(self.save_root):
-            # Define patterns for both files and directories
-            patterns = [
-                f"{name}*{post}.safetensors",
-                f"{name}*{post}.pt",
-                f"{name}*{post}"
+            # files and directories matching {name}*{post}
+            entries = [
+                e for e in self.get_save_root_entries()
+                if e.name.startswith(name) and e.name.endswith(post) and len(e.name) >= len(name) + len(post)
             ]
-            # Search for both files and directories
-            paths = []
-            for pattern in patterns:
-                paths.extend(glob.glob(os.path.join(self.save_root, pattern)))
-
-            # Filter out non-existent paths and sort by creation time
-            if paths:
-                paths = [p for p in paths if os.path.exists(p)]
-                # remove false positives
-                if '_LoRA' not in name:
-                    paths = [p for p in paths if '_LoRA' not in p]
-                if '_refiner' not in name:
-                    paths = [p for p in paths if '_refiner' not in p]
-                if '_t2i' not in name:
-                    paths = [p for p in paths if '_t2i' not in p]
-                if '_cn' not in name:
-                    paths = [p for p in paths if '_cn' not in p]
-
-                if len(paths) > 0:
-                    latest_path = max(paths, key=os.path.getctime)
+
+            # remove false positives
+            if '_LoRA' not in name:
+                entries = [e for e in entries if '_LoRA' not in e.path]
+            if '_refiner' not in name:
+                entries = [e for e in entries if '_refiner' not in e.path]
+            if '_t2i' not in name:
+                entries = [e for e in entries if '_t2i' not in e.path]
+            if '_cn' not in name:
+                entries = [e for e in entries if '_cn' not in e.path]
+
+            if len(entries) > 0:
+                latest_path = max(entries, key=lambda e: e.stat().st_ctime).path
 
         return latest_path
 
@@ -687,7 +786,10 @@ class BaseSDTrainProcess(BaseTrainProcess):
 
     def load_weights(self, path):
         if self.network is not None:
-            extra_weights = self.network.load_weights(path)
+            if path.endswith('.safetensors'):
+                extra_weights = self.network.load_weights(load_file_to_device(path, self.device_torch))
+            else:
+                extra_weights = self.network.load_weights(path)
             self.load_training_state_from_metadata(path)
             return extra_weights
         else:
@@ -712,7 +814,7 @@ class BaseSDTrainProcess(BaseTrainProcess):
         if latest_save_path is not None:
             # hacky way to reload weights for now
             # todo, do this
-            state_dict = load_file(latest_save_path, device=self.device)
+            state_dict = load_file_to_device(latest_save_path, self.device_torch)
             self.sd.unet.load_state_dict(state_dict)
 
             meta = load_metadata_from_safetensors(latest_save_path)
@@ -840,7 +942,7 @@ class BaseSDTrainProcess(BaseTrainProcess):
                     conditioned_prompts.append(prompt)
 
             with self.timer('prepare_latents'):
-                dtype = get_torch_dtype(self.train_config.dtype)
+                dtype = self._train_dtype
                 imgs = None
                 is_reg = any(batch.get_is_reg_list())
                 if batch.tensor is not None:
@@ -1138,14 +1240,14 @@ class BaseSDTrainProcess(BaseTrainProcess):
             adapter_name = f"{adapter_name}_{suffix}"
         latest_save_path = self.get_latest_save_path(adapter_name)
 
-        dtype = get_torch_dtype(self.train_config.dtype)
+        dtype = self._train_dtype
         if is_t2i:
             # if we do not have a last save path and we have a name_or_path,
             # load from that
             if latest_save_path is None and self.adapter_config.name_or_path is not None:
                 self.adapter = T2IAdapter.from_pretrained(
                     self.adapter_config.name_or_path,
-                    torch_dtype=get_torch_dtype(self.train_config.dtype),
+                    torch_dtype=self._train_dtype,
                     varient="fp16",
                     # use_safetensors=True,
                 )
@@ -1165,7 +1267,7 @@ class BaseSDTrainProcess(BaseTrainProcess):
                 load_from_path = latest_save_path
             self.adapter = ControlNetModel.from_pretrained(
                 load_from_path,
-                torch_dtype=get_torch_dtype(self.train_config.dtype),
+                torch_dtype=self._train_dtype,
             )
         elif self.adapter_config.type == 'clip':
             self.adapter = ClipVisionAdapter(
@@ -1267,7 +1369,7 @@ class BaseSDTrainProcess(BaseTrainProcess):
         # run base sd process run
         self.sd.load_model()
 
-        dtype = get_torch_dtype(self.train_config.dtype)
+        dtype = self._train_dtype
 
         # model is loaded from BaseSDProcess
         unet = self.sd.unet
@@ -1325,9 +1427,7 @@ class BaseSDTrainProcess(BaseTrainProcess):
                     text_encoder.gradient_checkpointing_enable()
 
         if self.sd.refiner_unet is not None:
-            self.sd.refiner_unet.to(self.device_torch, dtype=dtype)
-            self.sd.refiner_unet.requires_grad_(False)
-            self.sd.refiner_unet.eval()
+            freeze_module_to_device(self.sd.refiner_unet, self.device_torch, dtype)
             if self.train_config.xformers:
                 self.sd.refiner_unet.enable_xformers_memory_efficient_attention()
             if self.train_config.gradient_checkpointing:
@@ -1340,12 +1440,8 @@ class BaseSDTrainProcess(BaseTrainProcess):
         else:
             text_encoder.requires_grad_(False)
             text_encoder.eval()
-        unet.to(self.device_torch, dtype=dtype)
-        unet.requires_grad_(False)
-        unet.eval()
-        vae = vae.to(torch.device('cpu'), dtype=dtype)
-        vae.requires_grad_(False)
-        vae.eval()
+        freeze_module_to_device(unet, self.device_torch, dtype)
+        vae = freeze_module_to_device(vae, torch.device('cpu'), dtype)
         if self.train_config.learnable_snr_gos:
             self.snr_gos = LearnableSNRGamma(
                 self.sd.noise_scheduler, device=self.device_torch
@@ -1644,6 +1740,9 @@ class BaseSDTrainProcess(BaseTrainProcess):
         elif self.step_num <= 1 or self.train_config.force_first_sample:
             self.print("Generating baseline samples before training")
             self.sample(self.step_num)
+        else:
+            # resumed, the samples from the last save already show these weights
+            self.print(f"Resumed at step {self.step_num}, skipping baseline samples")
 
         self.progress_bar = ToolkitProgressBar(
             total=self.train_config.steps,
@@ -1651,19 +1750,21 @@ class BaseSDTrainProcess(BaseTrainProcess):
             leave=True,
             initial=self.step_num,
             iterable=range(0, self.train_config.steps),
+            # redraw at most twice a second
+            mininterval=0.5,
         )
         self.progress_bar.pause()
 
         if self.data_loader is not None:
             dataloader = self.data_loader
-            dataloader_iterator = iter(dataloader)
+            dataloader_iterator = self.iterate_dataloader_forever(dataloader)
         else:
             dataloader = None
             dataloader_iterator = None
 
         if self.data_loader_reg is not None:
             dataloader_reg = self.data_loader_reg
-            dataloader_iterator_reg = iter(dataloader_reg)
+            dataloader_iterator_reg = self.iterate_dataloader_forever(dataloader_reg, is_reg=True)
         else:
             dataloader_reg = None
             dataloader_iterator_reg = None
@@ -1691,201 +1792,198 @@ class BaseSDTrainProcess(BaseTrainProcess):
 
         start_step_num = self.step_num
         did_first_flush = False
-        for step in range(start_step_num, self.train_config.steps):
-            if self.train_config.do_paramiter_swapping:
-                self.optimizer.swap_paramiters()
-            self.timer.start('train_loop')
-            if self.train_config.do_random_cfg:
-                self.train_config.do_cfg = True
-                self.train_config.cfg_scale = value_map(random.random(), 0, 1, 1.0, self.train_config.max_cfg_scale)
-            self.step_num = step
-            # default to true so various things can turn it off
-            self.is_grad_accumulation_step = True
-            if self.train_config.free_u:
-                self.sd.pipeline.enable_freeu(s1=0.9, s2=0.2, b1=1.1, b2=1.2)
-            self.progress_bar.unpause()
-            with torch.no_grad():
-                # if is even step and we have a reg dataset, use that
-                # todo improve this logic to send one of each through if we can buckets and batch size might be an issue
-                is_reg_step = False
-                is_save_step = self.save_config.save_every and self.step_num % self.save_config.save_every == 0
-                is_sample_step = self.sample_config.sample_every and self.step_num % self.sample_config.sample_every == 0
-                if self.train_config.disable_sampling:
-                    is_sample_step = False
-
-                batch_list = []
-
-                for b in range(self.train_config.gradient_accumulation):
-                    # keep track to alternate on an accumulation step for reg   
-                    batch_step = step
-                    # don't do a reg step on sample or save steps as we dont want to normalize on those
-                    if batch_step % 2 == 0 and dataloader_reg is not None and not is_save_step and not is_sample_step:
-                        try:
+        # these do not change during training
+        is_d_adapt_optimizer = optimizer_type.startswith(('dadaptation', 'prodigy'))
+        first_param_group = optimizer.param_groups[0]
+        # progress bar postfix format, rebuilt if the loss keys change
+        prog_bar_keys = None
+        prog_bar_template = None
+        if self.gc_freq > 0:
+            gc.disable()
+        try:
+            for step in range(start_step_num, self.train_config.steps):
+                if self.train_config.do_paramiter_swapping:
+                    self.optimizer.swap_paramiters()
+                self.timer.start('train_loop')
+                if self.train_config.do_random_cfg:
+                    self.train_config.do_cfg = True
+                    self.train_config.cfg_scale = value_map(random.random(), 0, 1, 1.0, self.train_config.max_cfg_scale)
+                self.step_num = step
+                # default to true so various things can turn it off
+                self.is_grad_accumulation_step = True
+                if self.train_config.free_u:
+                    self.sd.pipeline.enable_freeu(s1=0.9, s2=0.2, b1=1.1, b2=1.2)
+                self.progress_bar.unpause()
+                with torch.no_grad():
+                    # if is even step and we have a reg dataset, use that
+                    # todo improve this logic to send one of each through if we can buckets and batch size might be an issue
+                    is_reg_step = False
+                    is_save_step = self.save_config.save_every and self.step_num % self.save_config.save_every == 0
+                    is_sample_step = self.sample_config.sample_every and self.step_num % self.sample_config.sample_every == 0
+                    if self.train_config.disable_sampling:
+                        is_sample_step = False
+
+                    batch_list = []
+
+                    for b in range(self.train_config.gradient_accumulation):
+                        # keep track to alternate on an accumulation step for reg   
+                        batch_step = step
+                        # don't do a reg step on sample or save steps as we dont want to normalize on those
+                        if batch_step % 2 == 0 and dataloader_reg is not None and not is_save_step and not is_sample_step:
                             with self.timer('get_batch:reg'):
                                 batch = next(dataloader_iterator_reg)
-                        except StopIteration:
-                            with self.timer('reset_batch:reg'):
-                                # hit the end of an epoch, reset
-                                self.progress_bar.pause()
-                                dataloader_iterator_reg = iter(dataloader_reg)
-                                trigger_dataloader_setup_epoch(dataloader_reg)
-
-                            with self.timer('get_batch:reg'):
-                                batch = next(dataloader_iterator_reg)
-                            self.progress_bar.unpause()
-                        is_reg_step = True
-                    elif dataloader is not None:
-                        try:
-                            with self.timer('get_batch'):
-                                batch = next(dataloader_iterator)
-                        except StopIteration:
-                            with self.timer('reset_batch'):
-                                # hit the end of an epoch, reset
-                                self.progress_bar.pause()
-                                dataloader_iterator = iter(dataloader)
-                                trigger_dataloader_setup_epoch(dataloader)
-                                self.epoch_num += 1
-                                if self.train_config.gradient_accumulation_steps == -1:
-                                    # if we are accumulating for an entire epoch, trigger a step
-                                    self.is_grad_accumulation_step = False
-                                    self.grad_accumulation_step = 0
+                            is_reg_step = True
+                        elif dataloader is not None:
                             with self.timer('get_batch'):
                                 batch = next(dataloader_iterator)
-                            self.progress_bar.unpause()
+                        else:
+                            batch = None
+                        batch_list.append(batch)
+                        batch_step += 1
+
+                    # setup accumulation
+                    if self.train_config.gradient_accumulation_steps == -1:
+                        # epoch is handling the accumulation, dont touch it
+                        pass
                     else:
-                        batch = None
-                    batch_list.append(batch)
-                    batch_step += 1
-
-                # setup accumulation
-                if self.train_config.gradient_accumulation_steps == -1:
-                    # epoch is handling the accumulation, dont touch it
-                    pass
-                else:
-                    # determine if we are accumulating or not
-                    # since optimizer step happens in the loop, we trigger it a step early
-                    # since we cannot reprocess it before them
-                    optimizer_step_at = self.train_config.gradient_accumulation_steps
-                    is_optimizer_step = self.grad_accumulation_step >= optimizer_step_at
-                    self.is_grad_accumulation_step = not is_optimizer_step
-                    if is_optimizer_step:
-                        self.grad_accumulation_step = 0
-
-            # flush()
-            ### HOOK ###
+                        # determine if we are accumulating or not
+                        # since optimizer step happens in the loop, we trigger it a step early
+                        # since we cannot reprocess it before them
+                        optimizer_step_at = self.train_config.gradient_accumulation_steps
+                        is_optimizer_step = self.grad_accumulation_step >= optimizer_step_at
+                        self.is_grad_accumulation_step = not is_optimizer_step
+                        if is_optimizer_step:
+                            self.grad_accumulation_step = 0
+
+                # flush()
+                ### HOOK ###
             
-            loss_dict = self.hook_train_loop(batch_list)
-            self.timer.stop('train_loop')
-            if not did_first_flush:
-                flush()
-                did_first_flush = True
-            # flush()
-            # setup the networks to gradient checkpointing and everything works
-            if self.adapter is not None and isinstance(self.adapter, ReferenceAdapter):
-                self.adapter.clear_memory()
-
-            with torch.no_grad():
-                # torch.cuda.empty_cache()
-                # if optimizer has get_lrs method, then use it
-                if hasattr(optimizer, 'get_avg_learning_rate'):
-                    learning_rate = optimizer.get_avg_learning_rate()
-                elif hasattr(optimizer, 'get_learning_rates'):
-                    learning_rate = optimizer.get_learning_rates()[0]
-                elif self.train_config.optimizer.lower().startswith('dadaptation') or \
-                        self.train_config.optimizer.lower().startswith('prodigy'):
-                    learning_rate = (
-                            optimizer.param_groups[0]["d"] *
-                            optimizer.param_groups[0]["lr"]
-                    )
-                else:
-                    learning_rate = optimizer.param_groups[0]['lr']
-
-                prog_bar_string = f"lr: {learning_rate:.1e}"
-                for key, value in loss_dict.items():
-                    prog_bar_string += f" {key}: {value:.3e}"
-
-                self.progress_bar.set_postfix_str(prog_bar_string)
-
-                # if the batch is a DataLoaderBatchDTO, then we need to clean it up
-                if isinstance(batch, DataLoaderBatchDTO):
-                    with self.timer('batch_cleanup'):
-                        batch.cleanup()
-
-                # don't do on first step
-                if self.step_num != self.start_step:
-                    if is_sample_step:
-                        self.progress_bar.pause()
-                        flush()
-                        # print above the progress bar
-                        if self.train_config.free_u:
-                            self.sd.pipeline.disable_freeu()
-                        self.sample(self.step_num)
-                        if self.train_config.unload_text_encoder:
-                            # make sure the text encoder is unloaded
-                            self.sd.text_encoder_to('cpu')
-                        flush()
-
-                        self.ensure_params_requires_grad()
-                        self.progress_bar.unpause()
-
-                    if is_save_step:
-                        # print above the progress bar
-                        self.progress_bar.pause()
-                        self.print(f"Saving at step {self.step_num}")
-                        self.save(self.step_num)
-                        self.ensure_params_requires_grad()
-                        self.progress_bar.unpause()
-
-                    if self.logging_config.log_every and self.step_num % self.logging_config.log_every == 0:
-                        self.progress_bar.pause()
-                        with self.timer('log_to_tensorboard'):
-                            # log to tensorboard
-                            if self.writer is not None:
-                                for key, value in loss_dict.items():
-                                    self.writer.add_scalar(f"{key}", value, self.step_num)
-                                self.writer.add_scalar(f"lr", learning_rate, self.step_num)
+                loss_dict = self.hook_train_loop(batch_list)
+                self.timer.stop('train_loop')
+                if not did_first_flush:
+                    flush()
+                    did_first_flush = True
+                elif self.train_config.empty_cache_every > 0 and self.step_num % self.train_config.empty_cache_every == 0:
+                    torch.cuda.empty_cache()
+                if self.gc_freq > 0 and self.step_num % self.gc_freq == 0:
+                    gc.collect(1)
+                # flush()
+                # setup the networks to gradient checkpointing and everything works
+                if self.adapter is not None and isinstance(self.adapter, ReferenceAdapter):
+                    self.adapter.clear_memory()
+
+                with torch.no_grad():
+                    # torch.cuda.empty_cache()
+                    # if optimizer has get_lrs method, then use it
+                    if hasattr(optimizer, 'get_avg_learning_rate'):
+                        learning_rate = optimizer.get_avg_learning_rate()
+                    elif hasattr(optimizer, 'get_learning_rates'):
+                        learning_rate = optimizer.get_learning_rates()[0]
+                    elif is_d_adapt_optimizer:
+                        learning_rate = first_param_group["d"] * first_param_group["lr"]
+                    else:
+                        learning_rate = first_param_group['lr']
+
+                    progress_every = self.logging_config.progress_every
+                    if not progress_every or self.step_num % progress_every == 0:
+                        loss_keys = tuple(loss_dict.keys())
+                        if loss_keys != prog_bar_keys:
+                            prog_bar_keys = loss_keys
+                            prog_bar_template = "lr: {:.1e}" + "".join(
+                                [f" {key.replace('{', '{{').replace('}', '}}')}: {{:.3e}}" for key in loss_keys]
+                            )
+                        # no refresh, the next update redraws it if enough time has passed
+                        self.progress_bar.set_postfix_str(
+                            prog_bar_template.format(learning_rate, *loss_dict.values()),
+                            refresh=False
+                        )
+
+                    # if the batch is a DataLoaderBatchDTO, then we need to clean it up
+                    if isinstance(batch, DataLoaderBatchDTO):
+                        with self.timer('batch_cleanup'):
+                            batch.cleanup()
+
+                    # don't do on first step
+                    if self.step_num != self.start_step:
+                        if is_sample_step:
+                            self.progress_bar.pause()
+                            # sample() flushes before generating
+                            # print above the progress bar
+                            if self.train_config.free_u:
+                                self.sd.pipeline.disable_freeu()
+                            self.sample(self.step_num)
+                            if self.train_config.unload_text_encoder:
+                                # make sure the text encoder is unloaded
+                                self.sd.text_encoder_to('cpu')
+                            flush()
+
+                            self.ensure_params_requires_grad()
+                            self.progress_bar.unpause()
+
+                        if is_save_step:
+                            # print above the progress bar
+                            self.progress_bar.pause()
+                            self.print(f"Saving at step {self.step_num}")
+                            self.save(self.step_num)
+                            self.ensure_params_requires_grad()
                             self.progress_bar.unpause()
+
+                        if self.logging_config.log_every and self.step_num % self.logging_config.log_every == 0:
+                            self.progress_bar.pause()
+                            with self.timer('log_to_tensorboard'):
+                                # log to tensorboard
+                                if self.writer is not None:
+                                    for key, value in loss_dict.items():
+                                        self.writer.add_scalar(f"{key}", value, self.step_num)
+                                    self.writer.add_scalar(f"lr", learning_rate, self.step_num)
+                                self.progress_bar.unpause()
                         
-                        # log to logger
-                        self.logger.log({
-                            'learning_rate': learning_rate,
-                        })
-                        for key, value in loss_dict.items():
+                            # log to logger
                             self.logger.log({
-                                f'loss/{key}': value,
+                                'learning_rate': learning_rate,
                             })
-                    elif self.logging_config.log_every is None: 
-                        # log every step
-                        self.logger.log({
-                            'learning_rate': learning_rate,
-                        })
-                        for key, value in loss_dict.items():
+                            for key, value in loss_dict.items():
+                                self.logger.log({
+                                    f'loss/{key}': value,
+                                })
+                        elif self.logging_config.log_every is None: 
+                            # log every step
                             self.logger.log({
-                                f'loss/{key}': value,
+                                'learning_rate': learning_rate,
                             })
+                            for key, value in loss_dict.items():
+                                self.logger.log({
+                                    f'loss/{key}': value,
+                                })
 
 
-                    if self.performance_log_every > 0 and self.step_num % self.performance_log_every == 0:
-                        self.progress_bar.pause()
-                        # print the timers and clear them
-                        self.timer.print()
-                        self.timer.reset()
-                        self.progress_bar.unpause()
+                        if self.performance_log_every > 0 and self.step_num % self.performance_log_every == 0:
+                            self.progress_bar.pause()
+                            # print the timers and clear them
+                            self.timer.print()
+                            self.timer.reset()
+                            self.progress_bar.unpause()
                 
-                # commit log
-                self.logger.commit(step=self.step_num)
+                    # commit log
+                    self.logger.commit(step=self.step_num)
+
+                    # sets progress bar to match out step
+                    self.progress_bar.update(step - self.progress_bar.n)
 
-                # sets progress bar to match out step
-                self.progress_bar.update(step - self.progress_bar.n)
+                    #############################
+                    # End of step
+                    #############################
 
-                #############################
-                # End of step
-                #############################
+                    # update various steps
+                    self.step_num = step + 1
+                    self.grad_accumulation_step += 1
 
-                # update various steps
-                self.step_num = step + 1
-                self.grad_accumulation_step += 1
+                    self.collect_finished_save()
 
+        finally:
+            # also on errors, otherwise gc stays off for anything that runs after us in this interpreter
+            if self.gc_freq > 0:
+                gc.enable()
 
         ###################################################################
         ##  END TRAIN LOOP
@@ -1899,6 +1997,7 @@ class BaseSDTrainProcess(BaseTrainProcess):
             self.logger.commit(step=self.step_num)
         print("")
         self.save()
+        self.wait_for_save()
         self.logger.finish()
 
         if self.save_config.push_to_hub:
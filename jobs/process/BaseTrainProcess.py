@@ -58,8 +58,8 @@ class BaseTrainProcess(BaseProcess):
     # def print(self, message, **kwargs):
     def print(self, *args):
         if self.progress_bar is not None:
+            # write is a tqdm classmethod, it prints above the bar without advancing it
             self.progress_bar.write(' '.join(map(str, args)))
-            self.progress_bar.update()
         else:
             print(*args)
 
@@ -13,7 +13,7 @@ from toolkit.models.RRDB import RRDBNet as ESRGAN, esrgan_safetensors_keys
 from safetensors.torch import save_file, load_file
 from torch.utils.data import DataLoader, ConcatDataset
 import torch
-from torch import nn
+import torch.nn.functional as F
 from torchvision.transforms import transforms
 
 from jobs.process import BaseTrainProcess
@@ -116,6 +116,10 @@ class TrainESRGANProcess(BaseTrainProcess):
             os.makedirs(self.save_root, exist_ok=True)
 
         self._pattern_loss = None
+        # built once, not per step
+        self._tv = ComparativeTotalVariation()
+        # returned by disabled losses. Never modify in place
+        self._zero = torch.zeros((), device=self.device)
 
         # build augmentation transforms
         aug_transforms = []
@@ -202,7 +206,7 @@ class TrainESRGANProcess(BaseTrainProcess):
                 torch.stack([loss.loss * scaler for loss, scaler in zip(self.style_losses, self.style_weight_scalers)]))
             return loss
         else:
-            return torch.tensor(0.0, device=self.device)
+            return self._zero
 
     def get_content_loss(self):
         if self.content_weight > 0:
@@ -211,23 +215,21 @@ class TrainESRGANProcess(BaseTrainProcess):
                 [loss.loss * scaler for loss, scaler in zip(self.content_losses, self.content_weight_scalers)]))
             return loss
         else:
-            return torch.tensor(0.0, device=self.device)
+            return self._zero
 
     def get_mse_loss(self, pred, target):
         if self.mse_weight > 0:
-            loss_fn = nn.MSELoss()
-            loss = loss_fn(pred, target)
+            loss = F.mse_loss(pred, target)
             return loss
         else:
-            return torch.tensor(0.0, device=self.device)
+            return self._zero
 
     def get_tv_loss(self, pred, target):
         if self.tv_weight > 0:
-            get_tv_loss = ComparativeTotalVariation()
-            loss = get_tv_loss(pred, target)
+            loss = self._tv(pred, target)
             return loss
         else:
-            return torch.tensor(0.0, device=self.device)
+            return self._zero
 
     def get_pattern_loss(self, pred, target):
         if self._pattern_loss is None:
@@ -246,7 +248,7 @@ class TrainESRGANProcess(BaseTrainProcess):
         step_num = ''
         if step is not None:
             # zeropad 9 digits
-            step_num = f"_{str(step).zfill(9)}"
+            step_num = f"_{step:09d}"
 
         self.update_training_metadata()
         # filename = f'{self.job.name}{step_num}.safetensors'
@@ -259,10 +261,13 @@ class TrainESRGANProcess(BaseTrainProcess):
         # state has the original state dict keys so we can save what we started from
         save_state_dict = self.model.state_dict()
 
+        # to() already makes a new tensor, no clone needed. Copies to the cpu non blocking land in
+        # pinned memory and are queued back to back, so we only sync once at the end
         for key in list(save_state_dict.keys()):
             v = save_state_dict[key]
-            v = v.detach().clone().to("cpu").to(torch.float32)
-            save_state_dict[key] = v
+            save_state_dict[key] = v.detach().to("cpu", dtype=torch.float32, non_blocking=True)
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
 
         # most things wont use safetensors, save as torch
         # save_file(save_state_dict, os.path.join(self.save_root, filename), save_meta)
@@ -353,7 +358,7 @@ class TrainESRGANProcess(BaseTrainProcess):
                 step_num = ''
                 if step is not None:
                     # zero-pad 9 digits
-                    step_num = f"_{str(step).zfill(9)}"
+                    step_num = f"_{step:09d}"
                 seconds_since_epoch = int(time.time())
                 # zero-pad 2 digits
                 i_str = str(i).zfill(2)
@@ -369,7 +374,7 @@ class TrainESRGANProcess(BaseTrainProcess):
                 for i in range(len(batch_inputs)):
                     if step is not None:
                         # zero-pad 9 digits
-                        step_num = f"_{str(step).zfill(9)}"
+                        step_num = f"_{step:09d}"
                     seconds_since_epoch = int(time.time())
                     # zero-pad 2 digits
                     i_str = str(i).zfill(2)
@@ -492,7 +497,9 @@ class TrainESRGANProcess(BaseTrainProcess):
         print("Generating baseline samples")
         self.sample(step=0)
         # range start at self.epoch_num go to self.epochs
-        critic_losses = []
+        # running critic loss kept on the device, read once per generator step
+        critic_loss_sum = None
+        critic_loss_count = 0
         for epoch in range(self.epoch_num, self.epochs, 1):
             if self.step_num >= self.max_steps:
                 break
@@ -533,15 +540,16 @@ class TrainESRGANProcess(BaseTrainProcess):
 
                 if is_critic_only_step:
                     critic_d_loss = self.critic.step(self.vgg19_pool_4.tensor.detach())
-                    critic_losses.append(critic_d_loss)
+                    critic_loss_sum = critic_d_loss if critic_loss_sum is None else critic_loss_sum + critic_d_loss
+                    critic_loss_count += 1
                     # don't do generator step
                     continue
                 else:
                     # doing a regular step
-                    if len(critic_losses) == 0:
+                    if critic_loss_count == 0:
                         critic_d_loss = 0
                     else:
-                        critic_d_loss = sum(critic_losses) / len(critic_losses)
+                        critic_d_loss = (critic_loss_sum / critic_loss_count).item()
 
                 style_loss = self.get_style_loss() * self.style_weight
                 content_loss = self.get_content_loss() * self.content_weight
@@ -552,7 +560,7 @@ class TrainESRGANProcess(BaseTrainProcess):
                 if self.use_critic:
                     critic_gen_loss = self.critic.get_critic_loss(self.vgg19_pool_4.tensor) * self.critic_weight
                 else:
-                    critic_gen_loss = torch.tensor(0.0, device=self.device, dtype=self.torch_dtype)
+                    critic_gen_loss = self._zero
 
                 loss = style_loss + content_loss + mse_loss + tv_loss + critic_gen_loss + pattern_loss
                 # make sure non nan
@@ -1,5 +1,4 @@
 import copy
-import glob
 import os
 import shutil
 import time
@@ -10,13 +9,13 @@ from PIL.ImageOps import exif_transpose
 from safetensors.torch import save_file, load_file
 from torch.utils.data import DataLoader, ConcatDataset
 import torch
-from torch import nn
+import torch.nn.functional as F
 from torchvision.transforms import transforms
 
 from jobs.process import BaseTrainProcess
 from toolkit.image_utils import show_tensors
 from toolkit.kohya_model_util import load_vae, convert_diffusers_back_to_ldm
-from toolkit.data_loader import ImageDataset
+from toolkit.data_loader import ImageDataset, CUDAPrefetcher, DALIImageLoader
 from toolkit.losses import ComparativeTotalVariation, get_gradient_penalty, PatternLoss
 from toolkit.metadata import get_meta_for_safetensors
 from toolkit.optimizer import get_optimizer
@@ -39,7 +38,10 @@ IMAGE_TRANSFORMS = transforms.Compose(
 
 
 def unnormalize(tensor):
-    return (tensor / 2 + 0.5).clamp(0, 1)
+    if tensor.requires_grad and torch.is_grad_enabled():
+        return (tensor * 0.5 + 0.5).clamp(0, 1)
+    # nothing to backprop through, so only allocate once and do the rest in place
+    return tensor.mul(0.5).add_(0.5).clamp_(0, 1)
 
 
 class TrainVAEProcess(BaseTrainProcess):
@@ -61,6 +63,7 @@ class TrainVAEProcess(BaseTrainProcess):
         self.dtype = self.get_conf('dtype', 'float32')
         self.sample_sources = self.get_conf('sample_sources', None)
         self.log_every = self.get_conf('log_every', 100, as_type=int)
+        self.progress_every = self.get_conf('progress_every', 10, as_type=int)
         self.style_weight = self.get_conf('style_weight', 0, as_type=float)
         self.content_weight = self.get_conf('content_weight', 0, as_type=float)
         self.kld_weight = self.get_conf('kld_weight', 0, as_type=float)
@@ -69,10 +72,25 @@ class TrainVAEProcess(BaseTrainProcess):
         self.lpips_weight = self.get_conf('lpips_weight', 1e0, as_type=float)
         self.critic_weight = self.get_conf('critic_weight', 1, as_type=float)
         self.pattern_weight = self.get_conf('pattern_weight', 1, as_type=float)
+        self.compile = self.get_conf('compile', False, as_type=bool)
+        self.dali = self.get_conf('dali', False, as_type=bool)
+        # compiled, the mul, add and clamp on pred fuse into one kernel
+        self._unnormalize = torch.compile(unnormalize, dynamic=False) if self.compile else unnormalize
         self.optimizer_params = self.get_conf('optimizer_params', {})
 
         self.blocks_to_train = self.get_conf('blocks_to_train', ['all'])
         self.torch_dtype = get_torch_dtype(self.dtype)
+        # autocast dtype for the forward pass. Params stay in self.torch_dtype
+        self.mixed_precision = self.get_conf('mixed_precision', 'no')
+        if self.mixed_precision not in ['no', 'bf16', 'fp16']:
+            raise ValueError(f"mixed_precision must be one of no, bf16, fp16. Got {self.mixed_precision}")
+        self.amp_dtype = get_torch_dtype(self.mixed_precision) if self.mixed_precision != 'no' else None
+        if self.mixed_precision == 'fp16' and self.torch_dtype != torch.float32:
+            # the grad scaler cannot unscale fp16 grads, it needs fp32 master weights
+            raise ValueError(f"mixed_precision fp16 requires dtype float32, got {self.dtype}")
+        self.device_type = torch.device(self.device).type
+        # bf16 has the fp32 exponent range, only fp16 needs loss scaling
+        self.scaler = torch.amp.GradScaler(self.device_type, enabled=self.mixed_precision == 'fp16')
         self.vgg_19 = None
         self.style_weight_scalers = []
         self.content_weight_scalers = []
@@ -115,6 +133,14 @@ class TrainVAEProcess(BaseTrainProcess):
             os.makedirs(self.save_root, exist_ok=True)
 
         self._pattern_loss = None
+        self._vgg_in = None
+        self._sample_inputs = None
+        self._latest_ckpt = None
+        self._latest_ckpt_scanned = False
+        # built once, not per step
+        self._tv = ComparativeTotalVariation()
+        # returned by disabled losses. Never modify in place
+        self._zero = torch.zeros((), device=self.device, dtype=self.torch_dtype)
 
     def update_training_metadata(self):
         self.add_meta(OrderedDict({"training_info": self.get_training_info()}))
@@ -126,6 +152,13 @@ class TrainVAEProcess(BaseTrainProcess):
         })
         return info
 
+    def autocast(self):
+        return torch.amp.autocast(
+            device_type=self.device_type,
+            dtype=self.amp_dtype,
+            enabled=self.amp_dtype is not None
+        )
+
     def load_datasets(self):
         if self.data_loader is None:
             print(f"Loading datasets")
@@ -134,25 +167,69 @@ class TrainVAEProcess(BaseTrainProcess):
                 print(f" - Dataset: {dataset['path']}")
                 ds = copy.copy(dataset)
                 ds['resolution'] = self.resolution
+                # workers ship uint8, we normalize after the copy to the gpu
+                ds['uint8'] = True
                 image_dataset = ImageDataset(ds)
                 datasets.append(image_dataset)
 
+            # a constant batch size keeps the compiled and cudnn kernels from being rebuilt for the short
+            # last batch. Only when there is at least one full batch, otherwise an epoch would be empty
+            drop_last = sum(len(image_dataset) for image_dataset in datasets) >= self.batch_size
+
+            if self.dali:
+                # decode on the gpu with dali. The datasets are still built so we get their filtered file lists
+                self.data_loader = DALIImageLoader(
+                    [file for image_dataset in datasets for file in image_dataset.file_list],
+                    batch_size=self.batch_size,
+                    resolution=self.resolution,
+                    device=self.device,
+                    random_crop=any(image_dataset.random_crop for image_dataset in datasets),
+                    drop_last=drop_last
+                )
+                return
+
             concatenated_dataset = ConcatDataset(datasets)
             self.data_loader = DataLoader(
                 concatenated_dataset,
                 batch_size=self.batch_size,
                 shuffle=True,
-                num_workers=6
+                num_workers=6,
+                # pinned batches let the copy to the gpu run async with the previous step
+                pin_memory=self.device_type == 'cuda',
+                persistent_workers=True,
+                prefetch_factor=4,
+                drop_last=drop_last
             )
 
+    def get_checkpoint_entries(self):
+        # one scandir, the DirEntry caches its stat so sorting by mtime does not stat every file again
+        if not os.path.isdir(self.save_root):
+            return []
+        with os.scandir(self.save_root) as it:
+            return [
+                entry for entry in it
+                if entry.name.startswith(self.job.name) and entry.name.endswith('_diffusers')
+            ]
+
+    def get_latest_checkpoint(self):
+        # cached until the next save
+        if not self._latest_ckpt_scanned:
+            entries = self.get_checkpoint_entries()
+            if len(entries) > 0:
+                self._latest_ckpt = max(entries, key=lambda entry: entry.stat().st_mtime).path
+            else:
+                self._latest_ckpt = None
+            self._latest_ckpt_scanned = True
+        return self._latest_ckpt
+
     def remove_oldest_checkpoint(self):
         max_to_keep = 4
-        folders = glob.glob(os.path.join(self.save_root, f"{self.job.name}*_diffusers"))
+        folders = self.get_checkpoint_entries()
         if len(folders) > max_to_keep:
-            folders.sort(key=os.path.getmtime)
+            folders.sort(key=lambda entry: entry.stat().st_mtime)
             for folder in folders[:-max_to_keep]:
-                print(f"Removing {folder}")
-                shutil.rmtree(folder)
+                print(f"Removing {folder.path}")
+                shutil.rmtree(folder.path)
 
     def setup_vgg19(self):
         if self.vgg_19 is None:
@@ -162,7 +239,7 @@ class TrainVAEProcess(BaseTrainProcess):
                 output_layer_name='pool_4',
                 dtype=self.torch_dtype
             )
-            self.vgg_19.to(self.device, dtype=self.torch_dtype)
+            self.vgg_19.to(self.device, dtype=self.torch_dtype, memory_format=torch.channels_last)
             self.vgg_19.requires_grad_(False)
 
             # we run random noise through first to get layer scalers to normalize the loss per layer
@@ -181,31 +258,49 @@ class TrainVAEProcess(BaseTrainProcess):
             self.print(f"Style weight scalers: {self.style_weight_scalers}")
             self.print(f"Content weight scalers: {self.content_weight_scalers}")
 
+            if self.compile:
+                # compile after the scaler pass so it runs eager. Compiled in place so the
+                # style, content and pool_4 hooks we hold references to are still the ones that run
+                self.vgg_19.compile(dynamic=False)
+
+    def get_vgg_input(self, pred, target):
+        # pred and target are stacked into one reused buffer instead of a new cat every step
+        batch_size = pred.shape[0]
+        shape = (batch_size * 2, *pred.shape[1:])
+        if self._vgg_in is None or self._vgg_in.shape != shape:
+            self._vgg_in = torch.empty(shape, device=self.device, dtype=self.torch_dtype,
+                                       memory_format=torch.channels_last)
+        # detach gives a fresh view so the buffer never carries autograd history between steps
+        stacked = self._vgg_in.detach()
+        with torch.no_grad():
+            stacked[batch_size:].copy_(target).mul_(0.5).add_(0.5).clamp_(0, 1)
+        stacked[:batch_size].copy_(self._unnormalize(pred))
+        return stacked
+
     def get_style_loss(self):
         if self.style_weight > 0:
             # scale all losses with loss scalers
             loss = torch.sum(
                 torch.stack([loss.loss * scaler for loss, scaler in zip(self.style_losses, self.style_weight_scalers)]))
-            return loss
+            return loss * self.style_weight
         else:
-            return torch.tensor(0.0, device=self.device)
+            return self._zero
 
     def get_content_loss(self):
         if self.content_weight > 0:
             # scale all losses with loss scalers
             loss = torch.sum(torch.stack(
                 [loss.loss * scaler for loss, scaler in zip(self.content_losses, self.content_weight_scalers)]))
-            return loss
+            return loss * self.content_weight
         else:
-            return torch.tensor(0.0, device=self.device)
+            return self._zero
 
     def get_mse_loss(self, pred, target):
         if self.mse_weight > 0:
-            loss_fn = nn.MSELoss()
-            loss = loss_fn(pred, target)
-            return loss
+            loss = F.mse_loss(pred, target)
+            return loss * self.mse_weight
         else:
-            return torch.tensor(0.0, device=self.device)
+            return self._zero
 
     def get_kld_loss(self, mu, log_var):
         if self.kld_weight > 0:
@@ -214,24 +309,25 @@ class TrainVAEProcess(BaseTrainProcess):
             # as we are not changing the distribution of the latent space
             # normally it would help keep a normal distribution for latents
             KLD = -0.5 * torch.sum(1 + log_var - mu.pow(2) - log_var.exp())  # KL divergence
-            return KLD
+            return KLD * self.kld_weight
         else:
-            return torch.tensor(0.0, device=self.device)
+            return self._zero
 
     def get_tv_loss(self, pred, target):
         if self.tv_weight > 0:
-            get_tv_loss = ComparativeTotalVariation()
-            loss = get_tv_loss(pred, target)
-            return loss
+            loss = self._tv(pred, target)
+            return loss * self.tv_weight
         else:
-            return torch.tensor(0.0, device=self.device)
+            return self._zero
 
     def get_pattern_loss(self, pred, target):
+        if self.pattern_weight == 0:
+            return self._zero
         if self._pattern_loss is None:
             self._pattern_loss = PatternLoss(pattern_size=16, dtype=self.torch_dtype).to(self.device,
                                                                                         dtype=self.torch_dtype)
         loss = torch.mean(self._pattern_loss(pred, target))
-        return loss
+        return loss * self.pattern_weight
 
     def save(self, step=None):
         if not os.path.exists(self.save_root):
@@ -240,31 +336,33 @@ class TrainVAEProcess(BaseTrainProcess):
         step_num = ''
         if step is not None:
             # zeropad 9 digits
-            step_num = f"_{str(step).zfill(9)}"
+            step_num = f"_{step:09d}"
 
         self.update_training_metadata()
         filename = f'{self.job.name}{step_num}_diffusers'
 
-        self.vae = self.vae.to("cpu", dtype=torch.float16)
+        # safetensors refuses non contiguous tensors, so drop channels_last for the save
+        self.vae = self.vae.to("cpu", dtype=torch.float16, memory_format=torch.contiguous_format)
         self.vae.save_pretrained(
             save_directory=os.path.join(self.save_root, filename)
         )
-        self.vae = self.vae.to(self.device, dtype=self.torch_dtype)
+        self.vae = self.vae.to(self.device, dtype=self.torch_dtype, memory_format=torch.channels_last)
 
         self.print(f"Saved to {os.path.join(self.save_root, filename)}")
+        # we just wrote the newest checkpoint
+        self._latest_ckpt = os.path.join(self.save_root, filename)
+        self._latest_ckpt_scanned = True
 
         if self.use_critic:
             self.critic.save(step)
 
         self.remove_oldest_checkpoint()
 
-    def sample(self, step=None):
-        sample_folder = os.path.join(self.save_root, 'samples')
-        if not os.path.exists(sample_folder):
-            os.makedirs(sample_folder, exist_ok=True)
-
-        with torch.no_grad():
-            for i, img_url in enumerate(self.sample_sources):
+    def get_sample_inputs(self):
+        # the sources never change, so load and preprocess them once
+        if self._sample_inputs is None:
+            input_imgs = []
+            for img_url in self.sample_sources:
                 img = exif_transpose(Image.open(img_url))
                 img = img.convert('RGB')
                 # crop if not square
@@ -273,50 +371,61 @@ class TrainVAEProcess(BaseTrainProcess):
                     img = img.crop((0, 0, min_dim, min_dim))
                 # resize
                 img = img.resize((self.resolution, self.resolution))
+                input_imgs.append(img)
+            imgs = torch.stack([IMAGE_TRANSFORMS(img) for img in input_imgs]).to(
+                self.device, dtype=self.torch_dtype, memory_format=torch.channels_last)
+            self._sample_inputs = (input_imgs, imgs)
+        return self._sample_inputs
+
+    def sample(self, step=None):
+        sample_folder = os.path.join(self.save_root, 'samples')
+        if not os.path.exists(sample_folder):
+            os.makedirs(sample_folder, exist_ok=True)
+
+        input_imgs, imgs = self.get_sample_inputs()
+        with torch.no_grad():
+            # all sources go through the vae as one batch
+            with self.autocast():
+                decoded = self.vae(imgs).sample
+            decoded = unnormalize(decoded)
+            # we always cast to float32 as this does not cause significant overhead and is compatible with bfloat16
+            decoded = decoded.cpu().permute(0, 2, 3, 1).float().numpy()
+
+        step_num = ''
+        if step is not None:
+            # zero-pad 9 digits
+            step_num = f"_{step:09d}"
+        seconds_since_epoch = int(time.time())
+
+        for i, input_img in enumerate(input_imgs):
+            # convert to pillow image
+            decoded_img = Image.fromarray((decoded[i] * 255).astype(np.uint8))
+
+            # stack input image and decoded image
+            decoded_img = decoded_img.resize((self.resolution, self.resolution))
 
-                input_img = img
-                img = IMAGE_TRANSFORMS(img).unsqueeze(0).to(self.device, dtype=self.torch_dtype)
-                img = img
-                decoded = self.vae(img).sample
-                decoded = (decoded / 2 + 0.5).clamp(0, 1)
-                # we always cast to float32 as this does not cause significant overhead and is compatible with bfloat16
-                decoded = decoded.cpu().permute(0, 2, 3, 1).squeeze(0).float().numpy()
-
-                # convert to pillow image
-                decoded = Image.fromarray((decoded * 255).astype(np.uint8))
-
-                # stack input image and decoded image
-                input_img = input_img.resize((self.resolution, self.resolution))
-                decoded = decoded.resize((self.resolution, self.resolution))
-
-                output_img = Image.new('RGB', (self.resolution * 2, self.resolution))
-                output_img.paste(input_img, (0, 0))
-                output_img.paste(decoded, (self.resolution, 0))
-
-                scale_up = 2
-                if output_img.height <= 300:
-                    scale_up = 4
-
-                # scale up using nearest neighbor
-                output_img = output_img.resize((output_img.width * scale_up, output_img.height * scale_up), Image.NEAREST)
-
-                step_num = ''
-                if step is not None:
-                    # zero-pad 9 digits
-                    step_num = f"_{str(step).zfill(9)}"
-                seconds_since_epoch = int(time.time())
-                # zero-pad 2 digits
-                i_str = str(i).zfill(2)
-                filename = f"{seconds_since_epoch}{step_num}_{i_str}.png"
-                output_img.save(os.path.join(sample_folder, filename))
+            output_img = Image.new('RGB', (self.resolution * 2, self.resolution))
+            output_img.paste(input_img, (0, 0))
+            output_img.paste(decoded_img, (self.resolution, 0))
+
+            scale_up = 2
+            if output_img.height <= 300:
+                scale_up = 4
+
+            # scale up using nearest neighbor
+            output_img = output_img.resize((output_img.width * scale_up, output_img.height * scale_up), Image.NEAREST)
+
+            # zero-pad 2 digits
+            i_str = str(i).zfill(2)
+            filename = f"{seconds_since_epoch}{step_num}_{i_str}.png"
+            output_img.save(os.path.join(sample_folder, filename))
 
     def load_vae(self):
         path_to_load = self.vae_path
         # see if we have a checkpoint in out output to resume from
         self.print(f"Looking for latest checkpoint in {self.save_root}")
-        files = glob.glob(os.path.join(self.save_root, f"{self.job.name}*_diffusers"))
-        if files and len(files) > 0:
-            latest_file = max(files, key=os.path.getmtime)
+        latest_file = self.get_latest_checkpoint()
+        if latest_file is not None:
             print(f" - Latest checkpoint is: {latest_file}")
             path_to_load = latest_file
             # todo update step and epoch count
@@ -329,10 +438,16 @@ class TrainVAEProcess(BaseTrainProcess):
             self.vae = AutoencoderKL.from_pretrained(path_to_load)
 
         # set decoder to train
-        self.vae.to(self.device, dtype=self.torch_dtype)
+        # channels_last lets cudnn pick the NHWC conv kernels
+        self.vae.to(self.device, dtype=self.torch_dtype, memory_format=torch.channels_last)
         self.vae.requires_grad_(False)
         self.vae.eval()
         self.vae.decoder.train()
+        if self.compile:
+            # compile in place so state dict keys do not get the _orig_mod prefix on save.
+            # default mode, reduce-overhead cuda graphs reuse output buffers between steps
+            self.vae.encoder.compile(dynamic=False)
+            self.vae.decoder.compile(dynamic=False)
         self.vae_scale_factor = 2 ** (len(self.vae.config['block_out_channels']) - 1)
 
     def run(self):
@@ -420,160 +535,160 @@ class TrainVAEProcess(BaseTrainProcess):
 
         # sample first
         self.sample()
-        blank_losses = OrderedDict({
-            "total": [],
-            "lpips": [],
-            "style": [],
-            "content": [],
-            "mse": [],
-            "kl": [],
-            "tv": [],
-            "ptn": [],
-            "crD": [],
-            "crG": [],
-        })
-        epoch_losses = copy.deepcopy(blank_losses)
-        log_losses = copy.deepcopy(blank_losses)
+        loss_keys = ["total", "lpips", "style", "content", "mse", "kl", "tv", "ptn", "crD", "crG"]
+        # running sums stay on the device so we only sync when we read them
+        epoch_losses = torch.zeros(len(loss_keys), device=self.device, dtype=torch.float32)
+        log_losses = torch.zeros(len(loss_keys), device=self.device, dtype=torch.float32)
+        epoch_count = 0
+        log_count = 0
+        # copies the next batch to the device while the current step runs
+        prefetcher = CUDAPrefetcher(self.data_loader, self.device, dtype=self.torch_dtype)
         # range start at self.epoch_num go to self.epochs
         for epoch in range(self.epoch_num, self.epochs, 1):
             if self.step_num >= self.max_steps:
                 break
-            for batch in self.data_loader:
+            for batch in prefetcher:
                 if self.step_num >= self.max_steps:
                     break
-                with torch.no_grad():
-
-                    batch = batch.to(self.device, dtype=self.torch_dtype)
-
-                    # resize so it matches size of vae evenly
-                    if batch.shape[2] % self.vae_scale_factor != 0 or batch.shape[3] % self.vae_scale_factor != 0:
-                        batch = Resize((batch.shape[2] // self.vae_scale_factor * self.vae_scale_factor,
-                                                batch.shape[3] // self.vae_scale_factor * self.vae_scale_factor))(batch)
-
-                    # forward pass
-                    dgd = self.vae.encode(batch).latent_dist
-                    mu, logvar = dgd.mean, dgd.logvar
-                    latents = dgd.sample()
-                    latents.detach().requires_grad_(True)
-
-                pred = self.vae.decode(latents).sample
-
-                with torch.no_grad():
-                    show_tensors(
-                        pred.clamp(-1, 1).clone(),
-                        "combined tensor"
-                    )
-
-                # Run through VGG19
-                if self.style_weight > 0 or self.content_weight > 0 or self.use_critic:
-                    stacked = torch.cat([pred, batch], dim=0)
-                    stacked = (stacked / 2 + 0.5).clamp(0, 1)
-                    self.vgg_19(stacked)
-
-                if self.use_critic:
-                    critic_d_loss = self.critic.step(self.vgg19_pool_4.tensor.detach())
-                else:
-                    critic_d_loss = 0.0
-
-                style_loss = self.get_style_loss() * self.style_weight
-                content_loss = self.get_content_loss() * self.content_weight
-                kld_loss = self.get_kld_loss(mu, logvar) * self.kld_weight
-                mse_loss = self.get_mse_loss(pred, batch) * self.mse_weight
-                if self.lpips_weight > 0:
-                    lpips_loss = self.lpips_loss(
-                        pred.clamp(-1, 1),
-                        batch.clamp(-1, 1)
-                    ).mean() * self.lpips_weight
-                else:
-                    lpips_loss = torch.tensor(0.0, device=self.device, dtype=self.torch_dtype)
-                tv_loss = self.get_tv_loss(pred, batch) * self.tv_weight
-                pattern_loss = self.get_pattern_loss(pred, batch) * self.pattern_weight
-                if self.use_critic:
-                    critic_gen_loss = self.critic.get_critic_loss(self.vgg19_pool_4.tensor) * self.critic_weight
-
-                    # do not let abs critic gen loss be higher than abs lpips * 0.1 if using it
+                with self.autocast():
+                    with torch.no_grad():
+                        # uint8 HWC to -1 to 1 NCHW. The permute leaves it in channels_last
+                        batch = batch.permute(0, 3, 1, 2).to(self.torch_dtype).mul_(1 / 127.5).sub_(1.0)
+
+                        # resize so it matches size of vae evenly
+                        if batch.shape[2] % self.vae_scale_factor != 0 or batch.shape[3] % self.vae_scale_factor != 0:
+                            batch = Resize((batch.shape[2] // self.vae_scale_factor * self.vae_scale_factor,
+                                                    batch.shape[3] // self.vae_scale_factor * self.vae_scale_factor))(batch)
+                        batch = batch.contiguous(memory_format=torch.channels_last)
+
+                        # forward pass
+                        dgd = self.vae.encode(batch).latent_dist
+                        mu, logvar = dgd.mean, dgd.logvar
+                        latents = dgd.sample()
+                        latents.detach().requires_grad_(True)
+
+                    pred = self.vae.decode(latents).sample
+
+                    with torch.no_grad():
+                        show_tensors(
+                            pred.clamp(-1, 1).clone(),
+                            "combined tensor"
+                        )
+
+                    # Run through VGG19
+                    if self.style_weight > 0 or self.content_weight > 0 or self.use_critic:
+                        self.vgg_19(self.get_vgg_input(pred, batch))
+
+                    if self.use_critic:
+                        pool_4 = self.vgg19_pool_4.tensor
+                        # the critic has its own optimizer and no grad scaler, keep it out of autocast
+                        with torch.autocast(device_type=self.device_type, enabled=False):
+                            critic_d_loss = self.critic.step(pool_4.detach())
+                    else:
+                        critic_d_loss = self._zero
+
+                    style_loss = self.get_style_loss()
+                    content_loss = self.get_content_loss()
+                    kld_loss = self.get_kld_loss(mu, logvar)
+                    mse_loss = self.get_mse_loss(pred, batch)
                     if self.lpips_weight > 0:
-                        max_target = lpips_loss.abs() * 0.1
-                        with torch.no_grad():
-                            crit_g_scaler = 1.0
-                            if critic_gen_loss.abs() > max_target:
-                                crit_g_scaler = max_target / critic_gen_loss.abs()
-
-                        critic_gen_loss *= crit_g_scaler
-                else:
-                    critic_gen_loss = torch.tensor(0.0, device=self.device, dtype=self.torch_dtype)
-
-                loss = style_loss + content_loss + kld_loss + mse_loss + tv_loss + critic_gen_loss + pattern_loss + lpips_loss
+                        lpips_loss = self.lpips_loss(
+                            pred.clamp(-1, 1),
+                            batch.clamp(-1, 1)
+                        ).mean() * self.lpips_weight
+                    else:
+                        lpips_loss = self._zero
+                    tv_loss = self.get_tv_loss(pred, batch)
+                    pattern_loss = self.get_pattern_loss(pred, batch)
+                    if self.use_critic:
+                        # must not be detached. This is the adversarial loss for the decoder, its gradient
+                        # flows from the frozen critic back through vgg19 to pred
+                        critic_gen_loss = self.critic.get_critic_loss(pool_4) * self.critic_weight
+
+                        # do not let abs critic gen loss be higher than abs lpips * 0.1 if using it
+                        if self.lpips_weight > 0:
+                            max_target = lpips_loss.abs() * 0.1
+                            with torch.no_grad():
+                                # where instead of an if so we do not sync on the comparison
+                                crit_g_abs = critic_gen_loss.abs()
+                                crit_g_scaler = torch.where(
+                                    crit_g_abs > max_target,
+                                    max_target / crit_g_abs,
+                                    torch.ones_like(crit_g_abs)
+                                )
+
+                            critic_gen_loss *= crit_g_scaler
+                    else:
+                        critic_gen_loss = self._zero
+
+                    loss = style_loss + content_loss + kld_loss + mse_loss + tv_loss + critic_gen_loss + pattern_loss + lpips_loss
 
                 # Backward pass and optimization
                 optimizer.zero_grad()
-                loss.backward()
-                optimizer.step()
+                self.scaler.scale(loss).backward()
+                self.scaler.step(optimizer)
+                self.scaler.update()
                 scheduler.step()
 
-                # update progress bar
-                loss_value = loss.item()
-                # get exponent like 3.54e-4
-                loss_string = f"loss: {loss_value:.2e}"
-                if self.lpips_weight > 0:
-                    loss_string += f" lpips: {lpips_loss.item():.2e}"
-                if self.content_weight > 0:
-                    loss_string += f" cnt: {content_loss.item():.2e}"
-                if self.style_weight > 0:
-                    loss_string += f" sty: {style_loss.item():.2e}"
-                if self.kld_weight > 0:
-                    loss_string += f" kld: {kld_loss.item():.2e}"
-                if self.mse_weight > 0:
-                    loss_string += f" mse: {mse_loss.item():.2e}"
-                if self.tv_weight > 0:
-                    loss_string += f" tv: {tv_loss.item():.2e}"
-                if self.pattern_weight > 0:
-                    loss_string += f" ptn: {pattern_loss.item():.2e}"
-                if self.use_critic and self.critic_weight > 0:
-                    loss_string += f" crG: {critic_gen_loss.item():.2e}"
-                if self.use_critic:
-                    loss_string += f" crD: {critic_d_loss:.2e}"
-
-                if self.optimizer_type.startswith('dadaptation') or \
-                        self.optimizer_type.lower().startswith('prodigy'):
-                    learning_rate = (
-                            optimizer.param_groups[0]["d"] *
-                            optimizer.param_groups[0]["lr"]
-                    )
-                else:
-                    learning_rate = optimizer.param_groups[0]['lr']
-
-                lr_critic_string = ''
-                if self.use_critic:
-                    lr_critic = self.critic.get_lr()
-                    lr_critic_string = f" lrC: {lr_critic:.1e}"
-
-                self.progress_bar.set_postfix_str(f"lr: {learning_rate:.1e}{lr_critic_string} {loss_string}")
+                step_losses = torch.stack([
+                    loss.detach(),
+                    lpips_loss.detach(),
+                    style_loss.detach(),
+                    content_loss.detach(),
+                    mse_loss.detach(),
+                    kld_loss.detach(),
+                    tv_loss.detach(),
+                    pattern_loss.detach(),
+                    critic_d_loss.detach(),
+                    critic_gen_loss.detach(),
+                ]).float()
+                epoch_losses += step_losses
+                log_losses += step_losses
+                epoch_count += 1
+                log_count += 1
+
+                # update progress bar. Reading the losses syncs, so only do it every few steps
+                if self.progress_every and self.step_num % self.progress_every == 0:
+                    step_values = dict(zip(loss_keys, step_losses.tolist()))
+                    # get exponent like 3.54e-4
+                    loss_string = f"loss: {step_values['total']:.2e}"
+                    if self.lpips_weight > 0:
+                        loss_string += f" lpips: {step_values['lpips']:.2e}"
+                    if self.content_weight > 0:
+                        loss_string += f" cnt: {step_values['content']:.2e}"
+                    if self.style_weight > 0:
+                        loss_string += f" sty: {step_values['style']:.2e}"
+                    if self.kld_weight > 0:
+                        loss_string += f" kld: {step_values['kl']:.2e}"
+                    if self.mse_weight > 0:
+                        loss_string += f" mse: {step_values['mse']:.2e}"
+                    if self.tv_weight > 0:
+                        loss_string += f" tv: {step_values['tv']:.2e}"
+                    if self.pattern_weight > 0:
+                        loss_string += f" ptn: {step_values['ptn']:.2e}"
+                    if self.use_critic and self.critic_weight > 0:
+                        loss_string += f" crG: {step_values['crG']:.2e}"
+                    if self.use_critic:
+                        loss_string += f" crD: {step_values['crD']:.2e}"
+
+                    if self.optimizer_type.startswith('dadaptation') or \
+                            self.optimizer_type.lower().startswith('prodigy'):
+                        learning_rate = (
+                                optimizer.param_groups[0]["d"] *
+                                optimizer.param_groups[0]["lr"]
+                        )
+                    else:
+                        learning_rate = optimizer.param_groups[0]['lr']
+
+                    lr_critic_string = ''
+                    if self.use_critic:
+                        lr_critic = self.critic.get_lr()
+                        lr_critic_string = f" lrC: {lr_critic:.1e}"
+
+                    self.progress_bar.set_postfix_str(f"lr: {learning_rate:.1e}{lr_critic_string} {loss_string}")
                 self.progress_bar.set_description(f"E: {epoch}")
                 self.progress_bar.update(1)
 
-                epoch_losses["total"].append(loss_value)
-                epoch_losses["lpips"].append(lpips_loss.item())
-                epoch_losses["style"].append(style_loss.item())
-                epoch_losses["content"].append(content_loss.item())
-                epoch_losses["mse"].append(mse_loss.item())
-                epoch_losses["kl"].append(kld_loss.item())
-                epoch_losses["tv"].append(tv_loss.item())
-                epoch_losses["ptn"].append(pattern_loss.item())
-                epoch_losses["crG"].append(critic_gen_loss.item())
-                epoch_losses["crD"].append(critic_d_loss)
-
-                log_losses["total"].append(loss_value)
-                log_losses["lpips"].append(lpips_loss.item())
-                log_losses["style"].append(style_loss.item())
-                log_losses["content"].append(content_loss.item())
-                log_losses["mse"].append(mse_loss.item())
-                log_losses["kl"].append(kld_loss.item())
-                log_losses["tv"].append(tv_loss.item())
-                log_losses["ptn"].append(pattern_loss.item())
-                log_losses["crG"].append(critic_gen_loss.item())
-                log_losses["crD"].append(critic_d_loss)
-
                 # don't do on first step
                 if self.step_num != start_step:
                     if self.sample_every and self.step_num % self.sample_every == 0:
@@ -590,23 +705,24 @@ class TrainVAEProcess(BaseTrainProcess):
                         # log to tensorboard
                         if self.writer is not None:
                             # get avg loss
-                            for key in log_losses:
-                                log_losses[key] = sum(log_losses[key]) / (len(log_losses[key]) + 1e-6)
-                                # if log_losses[key] > 0:
-                                self.writer.add_scalar(f"loss/{key}", log_losses[key], self.step_num)
+                            avg_losses = (log_losses / (log_count + 1e-6)).tolist()
+                            for key, value in zip(loss_keys, avg_losses):
+                                self.writer.add_scalar(f"loss/{key}", value, self.step_num)
                         # reset log losses
-                        log_losses = copy.deepcopy(blank_losses)
+                        log_losses.zero_()
+                        log_count = 0
 
                 self.step_num += 1
             # end epoch
             if self.writer is not None:
                 eps = 1e-6
                 # get avg loss
-                for key in epoch_losses:
-                    epoch_losses[key] = sum(log_losses[key]) / (len(log_losses[key]) + eps)
-                    if epoch_losses[key] > 0:
-                        self.writer.add_scalar(f"epoch loss/{key}", epoch_losses[key], epoch)
+                avg_losses = (epoch_losses / (epoch_count + eps)).tolist()
+                for key, value in zip(loss_keys, avg_losses):
+                    if value > 0:
+                        self.writer.add_scalar(f"epoch loss/{key}", value, epoch)
             # reset epoch losses
-            epoch_losses = copy.deepcopy(blank_losses)
+            epoch_losses.zero_()
+            epoch_count = 0
 
         self.save()
@@ -1,7 +1,5 @@
-import glob
 import os
 
-import numpy as np
 import torch
 import torch.nn as nn
 from safetensors.torch import load_file, save_file
@@ -84,6 +82,10 @@ class Critic:
         self.warmup_steps = warmup_steps
         self.start_step = start_step
         self.lambda_gp = lambda_gp
+        self._latest_ckpt = None
+        self._latest_ckpt_scanned = False
+        # returned before start_step, never modify in place
+        self._zero = torch.zeros((), dtype=self.torch_dtype, device=self.device)
 
         if optimizer_params is None:
             optimizer_params = {}
@@ -106,12 +108,27 @@ class Critic:
             verbose=False
         )
 
+    def get_latest_checkpoint(self):
+        # cached until the next save. scandir DirEntry caches its stat so we do not stat every file twice
+        if not self._latest_ckpt_scanned:
+            self._latest_ckpt = None
+            prefix = f"CRITIC_{self.process.job.name}"
+            if os.path.isdir(self.process.save_root):
+                with os.scandir(self.process.save_root) as it:
+                    entries = [
+                        entry for entry in it
+                        if entry.name.startswith(prefix) and entry.name.endswith('.safetensors')
+                    ]
+                if len(entries) > 0:
+                    self._latest_ckpt = max(entries, key=lambda entry: entry.stat().st_mtime).path
+            self._latest_ckpt_scanned = True
+        return self._latest_ckpt
+
     def load_weights(self):
         path_to_load = None
         self.print(f"Critic: Looking for latest checkpoint in {self.process.save_root}")
-        files = glob.glob(os.path.join(self.process.save_root, f"CRITIC_{self.process.job.name}*.safetensors"))
-        if files and len(files) > 0:
-            latest_file = max(files, key=os.path.getmtime)
+        latest_file = self.get_latest_checkpoint()
+        if latest_file is not None:
             print(f" - Latest checkpoint is: {latest_file}")
             path_to_load = latest_file
         else:
@@ -125,14 +142,16 @@ class Critic:
         step_num = ''
         if step is not None:
             # zeropad 9 digits
-            step_num = f"_{str(step).zfill(9)}"
+            step_num = f"_{step:09d}"
         save_path = os.path.join(self.process.save_root, f"CRITIC_{self.process.job.name}{step_num}.safetensors")
         save_file(self.model.state_dict(), save_path, save_meta)
         self.print(f"Saved critic to {save_path}")
+        self._latest_ckpt = save_path
+        self._latest_ckpt_scanned = True
 
     def get_critic_loss(self, vgg_output):
         if self.start_step > self.process.step_num:
-            return torch.tensor(0.0, dtype=self.torch_dtype, device=self.device)
+            return self._zero
 
         warmup_scaler = 1.0
         # we need a warmup when we come on of 1000 steps
@@ -154,12 +173,11 @@ class Critic:
         # train critic here
         self.model.train()
         self.model.requires_grad_(True)
-        self.optimizer.zero_grad()
+        # set_to_none skips the memset, backward allocates fresh grads
+        self.optimizer.zero_grad(set_to_none=True)
 
-        critic_losses = []
         inputs = vgg_output.detach()
         inputs = inputs.to(self.device, dtype=self.torch_dtype)
-        self.optimizer.zero_grad()
 
         vgg_pred, vgg_target = torch.chunk(inputs, 2, dim=0)
 
@@ -175,11 +193,9 @@ class Critic:
         torch.nn.utils.clip_grad_norm_(self.model.parameters(), 1.0)
         self.optimizer.step()
         self.scheduler.step()
-        critic_losses.append(critic_loss.item())
 
-        # avg loss
-        loss = np.mean(critic_losses)
-        return loss
+        # returned on the device so callers can accumulate it and only sync when they log it
+        return critic_loss.detach()
 
     def get_lr(self):
         if self.optimizer_type.startswith('dadaptation'):
@@ -32,6 +32,8 @@ class SaveConfig:
 class LoggingConfig:
     def __init__(self, **kwargs):
         self.log_every: int = kwargs.get('log_every', 100)
+        # how often to update the progress bar postfix with the lr and losses
+        self.progress_every: int = kwargs.get('progress_every', 10)
         self.verbose: bool = kwargs.get('verbose', False)
         self.use_wandb: bool = kwargs.get('use_wandb', False)
         self.project_name: str = kwargs.get('project_name', 'ai-toolkit')
@@ -393,6 +395,8 @@ class TrainConfig:
         self.do_paramiter_swapping = kwargs.get('do_paramiter_swapping', False)
         # 0.1 is 10% of the parameters active at a time lower is less vram, higher is more
         self.paramiter_swapping_factor = kwargs.get('paramiter_swapping_factor', 0.1)
+        # release cached cuda memory every n steps. 0 never does it. Only needed if memory keeps growing
+        self.empty_cache_every: int = kwargs.get('empty_cache_every', 0)
 
 
 class ModelConfig:
@@ -86,6 +86,8 @@ class ImageDataset(Dataset, CaptionMixin):
         self.random_crop = self.random_scale if self.random_scale else self.get_config('random_crop', False)
 
         self.resolution = self.get_config('resolution', 256)
+        # return raw HWC uint8 tensors and leave normalizing to the consumer (on the gpu)
+        self.uint8 = self.get_config('uint8', False)
         self.file_list = [os.path.join(self.path, file) for file in os.listdir(self.path) if
                           file.lower().endswith(('.jpg', '.jpeg', '.png', '.webp'))]
 
@@ -154,7 +156,10 @@ class ImageDataset(Dataset, CaptionMixin):
             img = transforms.CenterCrop(min_img_size)(img)
             img = img.resize((self.resolution, self.resolution), Image.BICUBIC)
 
-        img = self.transform(img)
+        if self.uint8:
+            img = torch.from_numpy(np.array(img, dtype=np.uint8))
+        else:
+            img = self.transform(img)
 
         if self.include_prompt:
             prompt = self.get_caption_item(index)
@@ -612,6 +617,10 @@ def get_dataloader_from_datasets(
     else:
         dataloader_kwargs['num_workers'] = dataset_config_list[0].num_workers
         dataloader_kwargs['prefetch_factor'] = dataset_config_list[0].prefetch_factor
+        # keep the workers alive between epochs instead of respawning them. Not possible with poi since
+        # it rebuilds the buckets every epoch in the main process and persistent workers would never see it
+        if dataloader_kwargs['num_workers'] > 0 and all([c.poi is None for c in dataset_config_list]):
+            dataloader_kwargs['persistent_workers'] = True
 
     if has_buckets:
         # make sure they all have buckets
@@ -675,3 +684,113 @@ def get_dataloader_datasets(dataloader: DataLoader):
         return dataloader.dataset.datasets
     else:
         return [dataloader.dataset]
+
+
+class CUDAPrefetcher:
+    """
+    Wraps a dataloader and copies the next batch to the device on a side stream while the
+    current batch is being used, so the transfer is hidden behind the training step.
+    Batches can be a tensor or a list / tuple of tensors. Works as a plain wrapper on cpu.
+    """
+
+    def __init__(self, data_loader: DataLoader, device, dtype=None):
+        self.data_loader = data_loader
+        self.device = torch.device(device)
+        self.dtype = dtype
+        self.stream = torch.cuda.Stream(device=self.device) if self.device.type == 'cuda' else None
+
+    def __len__(self):
+        return len(self.data_loader)
+
+    def _to_device(self, batch):
+        if isinstance(batch, torch.Tensor):
+            dtype = self.dtype if batch.is_floating_point() else None
+            return batch.to(self.device, dtype=dtype, non_blocking=True)
+        if isinstance(batch, (list, tuple)):
+            return type(batch)(self._to_device(item) for item in batch)
+        return batch
+
+    def _record_stream(self, batch, stream):
+        # tensors were allocated on the side stream, tell the allocator they are used on the main one
+        if isinstance(batch, torch.Tensor):
+            batch.record_stream(stream)
+        elif isinstance(batch, (list, tuple)):
+            for item in batch:
+                self._record_stream(item, stream)
+
+    def _preload(self, loader_iter):
+        try:
+            batch = next(loader_iter)
+        except StopIteration:
+            return None
+        with torch.cuda.stream(self.stream):
+            return self._to_device(batch)
+
+    def __iter__(self):
+        loader_iter = iter(self.data_loader)
+        if self.stream is None:
+            for batch in loader_iter:
+                yield self._to_device(batch)
+            return
+
+        next_batch = self._preload(loader_iter)
+        while next_batch is not None:
+            main_stream = torch.cuda.current_stream(self.device)
+            main_stream.wait_stream(self.stream)
+            batch = next_batch
+            self._record_stream(batch, main_stream)
+            # start copying the next one before handing this one out
+            next_batch = self._preload(loader_iter)
+            yield batch
+
+
+class DALIImageLoader:
+    """
+    Optional NVIDIA DALI loader for plain image folders. Decodes and crops on the gpu and yields
+    uint8 HWC batches already on the device, the same thing ImageDataset returns with uint8 set.
+    Center crop resizes the shorter side to resolution and crops the middle. Random crop takes a
+    resolution sized patch from the image at its native size. scale and random_scale are not supported.
+    """
+
+    def __init__(self, file_list, batch_size, resolution, device, random_crop=False, num_threads=6, drop_last=False):
+        try:
+            from nvidia.dali import pipeline_def, fn, types
+            from nvidia.dali.plugin.pytorch import DALIGenericIterator, LastBatchPolicy
+        except ImportError:
+            raise ImportError("Failed to import nvidia.dali. Please install it to use dali -> "
+                              "pip install nvidia-dali-cuda120 --extra-index-url https://pypi.nvidia.com")
+
+        device_id = torch.device(device).index or 0
+
+        @pipeline_def(batch_size=batch_size, num_threads=num_threads, device_id=device_id)
+        def image_pipeline():
+            encoded, _ = fn.readers.file(files=file_list, random_shuffle=True, name='Reader')
+            # mixed decodes on the gpu
+            images = fn.decoders.image(encoded, device='mixed', output_type=types.RGB)
+            if random_crop:
+                # native resolution patch, same as RandomCrop in ImageDataset
+                return fn.crop(
+                    images,
+                    crop=(resolution, resolution),
+                    crop_pos_x=fn.random.uniform(range=(0.0, 1.0)),
+                    crop_pos_y=fn.random.uniform(range=(0.0, 1.0))
+                )
+            images = fn.resize(images, resize_shorter=resolution, interp_type=types.INTERP_CUBIC)
+            return fn.crop(images, crop=(resolution, resolution), crop_pos_x=0.5, crop_pos_y=0.5)
+
+        pipe = image_pipeline()
+        pipe.build()
+        self.iterator = DALIGenericIterator(
+            pipe,
+            ['images'],
+            reader_name='Reader',
+            last_batch_policy=LastBatchPolicy.DROP if drop_last else LastBatchPolicy.PARTIAL,
+            auto_reset=True
+        )
+
+    def __len__(self):
+        return len(self.iterator)
+
+    def __iter__(self):
+        for batch in self.iterator:
+            yield batch[0]['images']
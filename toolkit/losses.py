@@ -29,28 +29,23 @@ def get_gradient_penalty(critic, real, fake, device):
     with torch.autocast(device_type='cuda'):
         real = real.float()
         fake = fake.float()
-        alpha = torch.rand(real.size(0), 1, 1, 1).to(device).float()
+        # made on the device, not on the cpu and copied over
+        alpha = torch.rand(real.size(0), 1, 1, 1, device=device)
         interpolates = (alpha * real + ((1 - alpha) * fake)).requires_grad_(True)
-        if torch.isnan(interpolates).any():
-            print('d_interpolates is nan')
         d_interpolates = critic(interpolates)
-        fake = torch.ones(real.size(0), 1, device=device)
-            
-        if torch.isnan(d_interpolates).any():
-            print('fake is nan')
+        grad_outputs = torch.ones(real.size(0), 1, device=device)
+
+        # each sample's critic output only depends on its own input, so one backward with
+        # ones as grad_outputs already gives every per sample input gradient
         gradients = torch.autograd.grad(
             outputs=d_interpolates,
             inputs=interpolates,
-            grad_outputs=fake,
+            grad_outputs=grad_outputs,
             create_graph=True,
             retain_graph=True,
             only_inputs=True,
         )[0]
 
-        # see if any are nan
-        if torch.isnan(gradients).any():
-            print('gradients is nan')
-
         gradients = gradients.view(gradients.size(0), -1)
         gradient_norm = gradients.norm(2, dim=1)
         gradient_penalty = ((gradient_norm - 1) ** 2).mean()
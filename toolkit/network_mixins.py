@@ -489,12 +489,13 @@ class ToolkitNetworkMixin:
 
         return keymap
 
-    def save_weights(
+    def get_save_dict(
             self: Network,
-            file, dtype=torch.float16,
+            dtype=torch.float16,
             metadata=None,
             extra_state_dict: Optional[OrderedDict] = None
     ):
+        # returns a cpu copy of the weights and the metadata to write so the write can happen elsewhere
         keymap = self.get_keymap()
 
         save_keymap = {}
@@ -544,6 +545,19 @@ class ToolkitNetworkMixin:
         if metadata is None:
             metadata = OrderedDict()
         metadata = add_model_hash_to_meta(state_dict, metadata)
+        return save_dict, metadata
+
+    def save_weights(
+            self: Network,
+            file, dtype=torch.float16,
+            metadata=None,
+            extra_state_dict: Optional[OrderedDict] = None
+    ):
+        save_dict, metadata = self.get_save_dict(
+            dtype=dtype,
+            metadata=metadata,
+            extra_state_dict=extra_state_dict
+        )
         if os.path.splitext(file)[1] == ".safetensors":
             from safetensors.torch import save_file
             save_file(save_dict, file, metadata)
@@ -2,6 +2,22 @@ import torch
 from transformers import Adafactor, AdamW
 
 
+def get_multi_tensor_kwargs(params, optimizer_params):
+    # torch adam / adamw can do the update for every param in one multi tensor kernel.
+    # fused needs every param to be a floating point cuda tensor, otherwise fall back to foreach
+    if 'fused' in optimizer_params or 'foreach' in optimizer_params:
+        return {}
+    tensors = []
+    for param in params:
+        if isinstance(param, dict):
+            tensors.extend(param['params'])
+        else:
+            tensors.append(param)
+    if len(tensors) > 0 and all(tensor.is_cuda and tensor.is_floating_point() for tensor in tensors):
+        return {'fused': True}
+    return {'foreach': True}
+
+
 def get_optimizer(
         params,
         optimizer_type='adam',
@@ -74,10 +90,19 @@ def get_optimizer(
             return bitsandbytes.optim.Lion8bit(params, lr=learning_rate, **optimizer_params)
         else:
             raise ValueError(f'Unknown optimizer type {optimizer_type}')
-    elif lower_type == 'adam':
-        optimizer = torch.optim.Adam(params, lr=float(learning_rate), eps=1e-6, **optimizer_params)
-    elif lower_type == 'adamw':
-        optimizer = torch.optim.AdamW(params, lr=float(learning_rate), eps=1e-6, **optimizer_params)
+    elif lower_type == 'adam' or lower_type == 'adamw':
+        # params can be a generator and we need to look at them first
+        params = list(params)
+        for param in params:
+            if isinstance(param, dict):
+                if isinstance(param['params'], torch.Tensor):
+                    param['params'] = [param['params']]
+                else:
+                    param['params'] = list(param['params'])
+        multi_tensor_kwargs = get_multi_tensor_kwargs(params, optimizer_params)
+        optimizer_class = torch.optim.Adam if lower_type == 'adam' else torch.optim.AdamW
+        optimizer = optimizer_class(params, lr=float(learning_rate), eps=1e-6, **multi_tensor_kwargs,
+                                    **optimizer_params)
     elif lower_type == 'lion':
         try:
             from lion_pytorch import Lion
@@ -1,9 +1,13 @@
+import itertools
 import json
 import os
-from collections import OrderedDict
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from typing import TYPE_CHECKING, Literal, Optional, Union
 
 import torch
+import safetensors.torch
+from safetensors import safe_open
 from safetensors.torch import load_file, save_file
 
 from toolkit.train_tools import get_torch_dtype
@@ -19,6 +23,70 @@ def get_slices_from_string(s: str) -> tuple:
     return tuple(slices)
 
 
+def save_file_bulk(
+        state_dict: 'OrderedDict',
+        output_file: str,
+        metadata: Optional['OrderedDict'] = None
+):
+    # serializes in memory and writes it out in as few large writes as possible instead of
+    # the many small writes save_file does. Holds the whole file in ram, so only use for smaller weights
+    state_dict = {k: v.contiguous() for k, v in state_dict.items()}
+    buffer = memoryview(safetensors.torch.save(state_dict, metadata=metadata))
+    with open(output_file, 'wb', buffering=0) as f:
+        written = 0
+        while written < len(buffer):
+            written += f.write(buffer[written:])
+
+
+def load_file_to_device(
+        path_to_file: str,
+        device: Union[str, torch.device] = 'cpu',
+        num_prefetch: int = 4
+) -> 'OrderedDict':
+    # loading safetensors directly to cuda page faults through the mmap during the copy.
+    # it is much faster to read to cpu, pin it, and do a non blocking copy to the device.
+    # reads are prefetched on worker threads so disk reads overlap the copies to the device
+    device = device if isinstance(device, torch.device) else torch.device(device)
+    if hasattr(os, 'posix_fadvise'):
+        # kick off kernel readahead for the whole file
+        fd = os.open(path_to_file, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        finally:
+            os.close(fd)
+    state_dict = OrderedDict()
+    if device.type != 'cuda':
+        # only the pinned copy path is cuda specific, let safetensors put it on any other device
+        with safe_open(path_to_file, framework='pt', device=str(device)) as f:
+            for key in f.keys():
+                state_dict[key] = f.get_tensor(key)
+        return state_dict
+    with safe_open(path_to_file, framework='pt', device='cpu') as f:
+        def read_pinned(key):
+            return f.get_tensor(key).pin_memory()
+
+        main_stream = torch.cuda.current_stream(device)
+        copy_stream = torch.cuda.Stream(device=device)
+        key_iter = iter(f.keys())
+        with ThreadPoolExecutor(max_workers=num_prefetch) as executor:
+            # bounded queue of pending reads
+            pending = deque()
+            for key in itertools.islice(key_iter, num_prefetch):
+                pending.append((key, executor.submit(read_pinned, key)))
+            with torch.cuda.stream(copy_stream):
+                while len(pending) > 0:
+                    key, future = pending.popleft()
+                    next_key = next(key_iter, None)
+                    if next_key is not None:
+                        pending.append((next_key, executor.submit(read_pinned, next_key)))
+                    tensor = future.result().to(device, non_blocking=True)
+                    # it will be used on the main stream
+                    tensor.record_stream(main_stream)
+                    state_dict[key] = tensor
+        main_stream.wait_stream(copy_stream)
+    return state_dict
+
+
 def convert_state_dict_to_ldm_with_mapping(
         diffusers_state_dict: 'OrderedDict',
         mapping_path: str,
@@ -200,7 +268,7 @@ def load_t2i_model(
         device: Union[str] = 'cpu',
         dtype: torch.dtype = torch.float32
 ):
-    raw_state_dict = load_file(path_to_file, device)
+    raw_state_dict = load_file_to_device(path_to_file, device)
     converted_state_dict = OrderedDict()
     for key, value in raw_state_dict.items():
         # todo see if we need to convert dict
@@ -240,7 +308,7 @@ def load_ip_adapter_model(
 ):
     # check if it is safetensors or checkpoint
     if path_to_file.endswith('.safetensors'):
-        raw_state_dict = load_file(path_to_file, device)
+        raw_state_dict = load_file_to_device(path_to_file, device)
         combined_state_dict = OrderedDict()
         if direct_load:
             return raw_state_dict
@@ -261,7 +329,7 @@ def load_custom_adapter_model(
 ):
     # check if it is safetensors or checkpoint
     if path_to_file.endswith('.safetensors'):
-        raw_state_dict = load_file(path_to_file, device)
+        raw_state_dict = load_file_to_device(path_to_file, device)
         combined_state_dict = OrderedDict()
         device = device if isinstance(device, torch.device) else torch.device(device)
         dtype = dtype if isinstance(dtype, torch.dtype) else get_torch_dtype(dtype)